@@ -0,0 +1,152 @@
+import sys
+import os.path
+import boto3
+from botocore.exceptions import ClientError
+import json
+from collections import OrderedDict
+import utils.utils as utils
+import utils.cache as cache
+import awsutils.policies as aws_policies
+import awsutils.roles as aws_roles
+from awsutils import paginate
+from awsutils.records import Role, InstanceProfile
+from utils.instrument import spanned
+
+'''
+Builds an in-memory snapshot of the account from paginated
+get_account_authorization_details calls.  A single pass returns every role
+(with its attached managed policies and instance profiles) and every local
+managed policy (with all of its versions), so the rest of the tool can work
+from the snapshot instead of making one IAM call per entity.  The details are
+turned into records (see awsutils.records) page by page, so only the fields
+the tool uses are kept.
+'''
+
+def storeRoleDetail(ctx, detail):
+    ctx.addRole(Role.fromResponse(detail))
+
+    roleName = detail['RoleName']
+    attached = []
+    for policy in detail['AttachedManagedPolicies']:
+        attached.append(policy['PolicyName'])
+    ctx.attachedPolicies[roleName] = attached
+
+    for profile in detail['InstanceProfileList']:
+        ctx.addInstanceProfile(InstanceProfile.fromResponse(profile))
+
+def storePolicyDetail(ctx, detail):
+    aws_policies.storePolicyMeta(ctx, detail)
+
+    versions = []
+    for version in detail.get('PolicyVersionList', []):
+        versions.append(version['VersionId'])
+        if version['IsDefaultVersion']:
+            ctx.awsPolicyDocs[detail['PolicyName']] = version['Document']
+    ctx.policyVersions[detail['Arn']] = aws_policies.sortVersions(versions)
+
+def storeAuthorizationDetails(ctx, filters):
+    iam = ctx.iam
+    for page in paginate.pages(iam, 'get_account_authorization_details', Filter=filters):
+        for detail in page['RoleDetailList']:
+            storeRoleDetail(ctx, detail)
+        for detail in page['Policies']:
+            storePolicyDetail(ctx, detail)
+
+def loadFullSnapshot(ctx):
+    ctx.vlog('loadSnapshot: Getting account authorization details from AWS')
+    storeAuthorizationDetails(ctx, ['Role', 'LocalManagedPolicy'])
+
+def loadRevalidatedSnapshot(ctx):
+    ctx.vlog('loadSnapshot: Revalidating cached policies against AWS')
+    storeAuthorizationDetails(ctx, ['Role'])
+
+    cachedMetas = ctx.cache.getPolicyMetas(ctx.orgId)
+    unchanged = 0
+    iam = ctx.iam
+    for meta in paginate.iterate(iam, 'list_policies', 'Policies', Scope='Local'):
+        cached = cachedMetas.get(meta['Arn'])
+        if cached != None and cached['UpdateDate'] == cache.updateDate(meta):
+            unchanged += 1
+        aws_policies.storePolicyMeta(ctx, meta)
+
+    missing = []
+    for policyName, meta in ctx.awsPolicyMeta.items():
+        policyDoc = ctx.cache.getDocument(ctx.orgId, meta.arn, meta.defaultVersionId)
+        if policyDoc == None:
+            missing.append(policyName)
+        else:
+            ctx.awsPolicyDocs[policyName] = policyDoc
+    ctx.vlog('loadSnapshot: %d policies unchanged since last run, %d documents to fetch' % (
+        unchanged, len(missing)))
+    aws_policies.prefetchPolicyDocuments(ctx, missing)
+
+def loadCachedSnapshot(ctx):
+    ctx.vlog('loadSnapshot: Loading cached account state')
+    if not ctx.cache.hasSnapshot(ctx.orgId):
+        ctx.log('Error: no cached IAM state for account %s.  Run once without --offline' % ctx.orgId, color='red')
+        sys.exit(1)
+    for role in ctx.cache.getEntities(ctx.orgId, 'roles'):
+        ctx.addRole(Role.fromResponse(role))
+    ctx.attachedPolicies.update(ctx.cache.getEntities(ctx.orgId, 'attachedPolicies'))
+    for profile in ctx.cache.getEntities(ctx.orgId, 'instanceProfiles').values():
+        ctx.addInstanceProfile(InstanceProfile.fromResponse(profile))
+    for meta in ctx.cache.getPolicyMetas(ctx.orgId).values():
+        aws_policies.storePolicyMeta(ctx, meta)
+        policyDoc = ctx.cache.getDocument(ctx.orgId, meta['Arn'], meta['DefaultVersionId'])
+        if policyDoc != None:
+            ctx.awsPolicyDocs[meta['PolicyName']] = policyDoc
+
+def saveSnapshot(ctx):
+    ctx.cache.putEntities(ctx.orgId, 'roles', [role.asDict() for role in ctx.currentRoles])
+    ctx.cache.putEntities(ctx.orgId, 'attachedPolicies', ctx.attachedPolicies)
+    ctx.cache.putEntities(ctx.orgId, 'instanceProfiles', OrderedDict(
+        (profileId, profile.asDict()) for profileId, profile in ctx.instanceProfiles.items()))
+    ctx.cache.putPolicyMetas(ctx.orgId, [meta.asDict() for meta in ctx.awsPolicyMeta.values()])
+    for policyName, policyDoc in ctx.awsPolicyDocs.items():
+        meta = ctx.awsPolicyMeta[policyName]
+        ctx.cache.putDocument(ctx.orgId, meta.arn, meta.defaultVersionId, policyDoc)
+    ctx.cache.commit()
+
+def loadSnapshot(ctx):
+    if ctx.snapshotLoaded:
+        return
+    if ctx.cache == None:
+        loadFullSnapshot(ctx)
+    elif ctx.offline:
+        loadCachedSnapshot(ctx)
+    elif ctx.refresh or not ctx.cache.hasSnapshot(ctx.orgId):
+        loadFullSnapshot(ctx)
+    else:
+        loadRevalidatedSnapshot(ctx)
+
+    ctx.snapshotLoaded = True
+    if ctx.cache != None and not ctx.offline:
+        saveSnapshot(ctx)
+    ctx.vlog('loadSnapshot: %d roles, %d policies, %d instance profiles' % (
+        len(ctx.rolesByName), len(ctx.awsPolicyMeta), len(ctx.instanceProfiles)))
+
+'''
+Commands declare what they need from AWS through the loaders below.  A
+command scoped to a single policy or role makes only the calls for that
+entity; anything wider loads the whole account snapshot.  In offline mode
+everything comes from the cached snapshot.
+'''
+@spanned('discovery')
+def loadPolicies(ctx, policyName=None):
+    if policyName == None or ctx.offline:
+        loadSnapshot(ctx)
+    else:
+        aws_policies.getPolicyMeta(ctx, policyName)
+
+@spanned('discovery')
+def loadProfiles(ctx):
+    # Instance profiles are listed on demand, unless we are offline
+    if ctx.offline:
+        loadSnapshot(ctx)
+
+@spanned('discovery')
+def loadRoles(ctx, roleName=None):
+    if roleName == None or ctx.offline:
+        loadSnapshot(ctx)
+    else:
+        aws_roles.fetchRole(ctx, roleName)
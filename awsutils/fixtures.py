@@ -0,0 +1,559 @@
+import os.path
+import json
+import copy
+import time
+import random
+import threading
+from collections import OrderedDict, Counter
+from datetime import datetime
+from urllib.parse import quote, unquote
+import boto3
+from botocore.awsrequest import AWSResponse
+from awsutils.ratelimit import acquireAttempt
+
+'''
+A local stand-in for the IAM and EC2 APIs, served from recorded fixtures.
+
+installFixtureClients builds real boto3 clients and hooks their before-call
+event, so that every request is answered from an in-memory account instead
+of being sent to AWS.  Parameter validation, paginators, and the decoding of
+policy documents all run exactly as they do against AWS.
+
+The account is loaded from a fixture folder holding recorded API responses,
+one file per operation.  A file is found under the operation name, with or
+without its verb, so instance_profiles.json is read as the response to
+list_instance_profiles:
+
+    get_account_authorization_details.json   roles, policies and versions
+    list_instance_profiles.json              instance profiles
+    describe_instances.json                  EC2 reservations
+
+Every file is optional.  A file may hold a single response, or a list of
+recorded response pages.  The other IAM reads (get_role, list_policies and
+so on) are answered from the same account, and changes made through the
+clients are applied to it, so a whole session behaves consistently.
+
+The backend spec is 'fixtures:DIR' followed by optional comma separated
+settings, e.g. 'fixtures:bench/1k,latency=0.02,throttle=0.05':
+
+    latency     seconds added to every call
+    throttle    probability that an attempt is throttled
+    page_size   default page size of the list calls
+    seed        seed for the throttle decisions
+
+Throttling is modelled on the SDK's own retries: a throttled attempt costs a
+backoff delay and is tried again, and the caller only sees the Throttling
+error when every attempt of a call was throttled.  As calls are answered
+before botocore sends them, each attempt takes its rate limiter token here.
+'''
+
+URL = 'https://fixtures.invalid/'
+
+settingTypes = {'latency': float, 'throttle': float, 'page_size': int, 'seed': int}
+
+def parseBackend(spec):
+    ''' Returns (fixtureDir, settings) for a 'fixtures:DIR[,name=value...]' spec '''
+    if not spec.startswith('fixtures:'):
+        raise ValueError('unknown backend %s' % spec)
+    parts = spec[len('fixtures:'):].split(',')
+    settings = {}
+    for part in parts[1:]:
+        name, _, value = part.partition('=')
+        if name not in settingTypes:
+            raise ValueError('unknown fixtures setting %s' % name)
+        settings[name] = settingTypes[name](value)
+    return parts[0], settings
+
+def encodeDocument(document):
+    return quote(json.dumps(document))
+
+def decodeDocument(document):
+    if isinstance(document, str):
+        return json.loads(unquote(document))
+    return document
+
+def storedRole(role):
+    # Role trust policies go over the wire URL encoded, like policy documents
+    role = dict(role)
+    if 'AssumeRolePolicyDocument' in role:
+        role['AssumeRolePolicyDocument'] = encodeDocument(decodeDocument(role['AssumeRolePolicyDocument']))
+    return role
+
+def storedProfile(profile):
+    profile = dict(profile)
+    profile['Roles'] = [storedRole(role) for role in profile.get('Roles', [])]
+    return profile
+
+def mergePages(data, keys):
+    if not isinstance(data, list):
+        return data
+    merged = {}
+    for page in data:
+        for key in keys:
+            merged.setdefault(key, []).extend(page.get(key, []))
+    return merged
+
+def findRoleName(roles, roleName):
+    for role in roles:
+        if role['RoleName'] == roleName:
+            return True
+    return False
+
+
+class FixtureError(Exception):
+    def __init__(self, status, code, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.code = code
+
+
+class FixtureBackend(object):
+    def __init__(self, fixtureDir, latency=0.0, throttle=0.0, page_size=100, seed=0):
+        self.fixtureDir = fixtureDir
+        self.latency = latency
+        self.throttle = throttle
+        self.pageSize = page_size
+        self.random = random.Random(seed)
+        self.maxAttempts = 5
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.serviceCalls = Counter()
+        self.throttles = 0
+
+        self.roles = OrderedDict()
+        self.attached = {}
+        self.policies = OrderedDict()
+        self.versions = {}
+        self.profiles = OrderedDict()
+        self.reservations = []
+        self.listing = None
+        self.load()
+
+    '''
+    Loading the recorded account
+    '''
+    def loadFixture(self, operation, keys):
+        names = [operation, operation.split('_', 1)[1]]
+        for name in names:
+            path = os.path.join(self.fixtureDir, name + '.json')
+            if os.path.exists(path):
+                with open(path) as f:
+                    return mergePages(json.load(f), keys)
+        return {}
+
+    def load(self):
+        details = self.loadFixture('get_account_authorization_details', ['RoleDetailList', 'Policies'])
+        for detail in details.get('RoleDetailList', []):
+            role = storedRole(detail)
+            attached = role.pop('AttachedManagedPolicies', [])
+            profiles = role.pop('InstanceProfileList', [])
+            role.pop('RolePolicyList', None)
+            self.roles[role['RoleName']] = role
+            self.attached[role['RoleName']] = [policy['PolicyArn'] for policy in attached]
+            for profile in profiles:
+                self.profiles[profile['InstanceProfileName']] = storedProfile(profile)
+        for detail in details.get('Policies', []):
+            meta = dict(detail)
+            versions = OrderedDict()
+            for version in meta.pop('PolicyVersionList', []):
+                version = dict(version)
+                version['Document'] = decodeDocument(version['Document'])
+                versions[version['VersionId']] = version
+            self.policies[meta['Arn']] = meta
+            self.versions[meta['Arn']] = versions
+
+        profiles = self.loadFixture('list_instance_profiles', ['InstanceProfiles'])
+        for profile in profiles.get('InstanceProfiles', []):
+            self.profiles[profile['InstanceProfileName']] = storedProfile(profile)
+
+        instances = self.loadFixture('describe_instances', ['Reservations'])
+        self.reservations = instances.get('Reservations', [])
+
+    '''
+    Client plumbing
+    '''
+    def install(self, client):
+        client.meta.events.register('before-parameter-build', self.stashParams)
+        client.meta.events.register('before-call', self.handle)
+
+    def stashParams(self, params, context, **kwargs):
+        context['fixtureParams'] = copy.deepcopy(params)
+
+    def throttledAttempts(self, context):
+        ''' Returns how many attempts were throttled; maxAttempts means the call failed '''
+        for attempt in range(self.maxAttempts):
+            acquireAttempt(context)
+            with self.lock:
+                throttled = self.random.random() < self.throttle
+                if throttled:
+                    self.throttles += 1
+            if not throttled:
+                return attempt
+            time.sleep(self.random.uniform(0, 0.05 * (2 ** attempt)))
+        return self.maxAttempts
+
+    def handle(self, model, context, **kwargs):
+        operation = model.name
+        params = context.get('fixtureParams', {})
+        with self.lock:
+            self.calls[operation] += 1
+            self.serviceCalls[model.service_model.endpoint_prefix] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        retries = 0
+        if self.throttle > 0:
+            retries = self.throttledAttempts(context)
+            if retries == self.maxAttempts:
+                return self.error(400, 'Throttling', 'Rate exceeded', retries - 1)
+        else:
+            acquireAttempt(context)
+
+        method = getattr(self, operation, None)
+        if method == None:
+            return self.error(400, 'InvalidAction', 'The fixtures backend does not support %s' % operation, retries)
+        try:
+            with self.lock:
+                response = copy.deepcopy(method(params))
+        except FixtureError as err:
+            return self.error(err.status, err.code, str(err), retries)
+        response['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RequestId': 'fixtures', 'RetryAttempts': retries}
+        return AWSResponse(URL, 200, {}, None), response
+
+    def error(self, status, code, message, retries=0):
+        response = {
+            'Error': {'Code': code, 'Message': message},
+            'ResponseMetadata': {'HTTPStatusCode': status, 'RequestId': 'fixtures', 'RetryAttempts': retries}
+        }
+        return AWSResponse(URL, status, {}, None), response
+
+    def page(self, items, params, key):
+        start = int(params.get('Marker') or 0)
+        size = params.get('MaxItems') or self.pageSize
+        response = {key: items[start:start + size], 'IsTruncated': start + size < len(items)}
+        if response['IsTruncated']:
+            response['Marker'] = str(start + size)
+        return response
+
+    '''
+    Entity lookups
+    '''
+    def role(self, roleName):
+        if roleName not in self.roles:
+            raise FixtureError(404, 'NoSuchEntity', 'The role with name %s cannot be found.' % roleName)
+        return self.roles[roleName]
+
+    def policy(self, policyArn):
+        if policyArn not in self.policies:
+            raise FixtureError(404, 'NoSuchEntity', 'Policy %s does not exist.' % policyArn)
+        return self.policies[policyArn]
+
+    def profile(self, profileName):
+        if profileName not in self.profiles:
+            raise FixtureError(404, 'NoSuchEntity', 'Instance Profile %s cannot be found.' % profileName)
+        return self.profiles[profileName]
+
+    def attachedPolicies(self, roleName):
+        attached = []
+        for policyArn in self.attached[roleName]:
+            attached.append({'PolicyName': policyArn.split('/')[-1], 'PolicyArn': policyArn})
+        return attached
+
+    def profilesForRole(self, roleName):
+        return [profile for profile in self.profiles.values() if findRoleName(profile['Roles'], roleName)]
+
+    def policyVersion(self, version):
+        version = dict(version)
+        version['Document'] = encodeDocument(version['Document'])
+        return version
+
+    def accountName(self):
+        # The recorded policies carry the account id in their ARNs
+        for policyArn in self.policies:
+            return policyArn.split(':')[4]
+        return '000000000000'
+
+    '''
+    IAM reads
+    '''
+    def GetAccountAuthorizationDetails(self, params):
+        filters = params.get('Filter', ['Role', 'LocalManagedPolicy'])
+        if not params.get('Marker') or self.listing == None:
+            # The listing is taken on the first page and kept for the
+            # following ones, and only the details of each page are built
+            items = []
+            if 'Role' in filters:
+                items.extend(('RoleDetailList', roleName) for roleName in self.roles)
+            if 'LocalManagedPolicy' in filters:
+                items.extend(('Policies', policyArn) for policyArn in self.policies)
+            profilesByRole = {}
+            for profile in self.profiles.values():
+                for role in profile['Roles']:
+                    profilesByRole.setdefault(role['RoleName'], []).append(profile)
+            self.listing = (items, profilesByRole)
+        items, profilesByRole = self.listing
+        response = self.page(items, params, 'Items')
+        response['RoleDetailList'] = []
+        response['Policies'] = []
+        for key, name in response.pop('Items'):
+            if key == 'RoleDetailList':
+                detail = dict(self.roles[name])
+                detail['AttachedManagedPolicies'] = self.attachedPolicies(name)
+                detail['InstanceProfileList'] = profilesByRole.get(name, [])
+                detail['RolePolicyList'] = []
+            else:
+                detail = dict(self.policies[name])
+                detail['PolicyVersionList'] = [self.policyVersion(version) for version in self.versions[name].values()]
+            response[key].append(detail)
+        response['UserDetailList'] = []
+        response['GroupDetailList'] = []
+        return response
+
+    def GetRole(self, params):
+        return {'Role': self.role(params['RoleName'])}
+
+    def ListRoles(self, params):
+        prefix = params.get('PathPrefix', '/')
+        roles = [role for role in self.roles.values() if role['Path'].startswith(prefix)]
+        return self.page(roles, params, 'Roles')
+
+    def ListAttachedRolePolicies(self, params):
+        self.role(params['RoleName'])
+        return self.page(self.attachedPolicies(params['RoleName']), params, 'AttachedPolicies')
+
+    def GetPolicy(self, params):
+        return {'Policy': self.policy(params['PolicyArn'])}
+
+    def ListPolicies(self, params):
+        return self.page(list(self.policies.values()), params, 'Policies')
+
+    def GetPolicyVersion(self, params):
+        versions = self.versions[self.policy(params['PolicyArn'])['Arn']]
+        if params['VersionId'] not in versions:
+            raise FixtureError(404, 'NoSuchEntity', 'Policy version %s does not exist.' % params['VersionId'])
+        return {'PolicyVersion': self.policyVersion(versions[params['VersionId']])}
+
+    def ListPolicyVersions(self, params):
+        versions = []
+        for version in self.versions[self.policy(params['PolicyArn'])['Arn']].values():
+            version = dict(version)
+            del version['Document']
+            versions.append(version)
+        return self.page(versions, params, 'Versions')
+
+    def ListEntitiesForPolicy(self, params):
+        policyArn = self.policy(params['PolicyArn'])['Arn']
+        roles = []
+        for roleName, attached in self.attached.items():
+            if policyArn in attached:
+                roles.append({'RoleName': roleName, 'RoleId': self.roles[roleName].get('RoleId')})
+        response = self.page(roles, params, 'PolicyRoles')
+        response['PolicyUsers'] = []
+        response['PolicyGroups'] = []
+        return response
+
+    def GetInstanceProfile(self, params):
+        return {'InstanceProfile': self.profile(params['InstanceProfileName'])}
+
+    def ListInstanceProfiles(self, params):
+        return self.page(list(self.profiles.values()), params, 'InstanceProfiles')
+
+    def ListInstanceProfilesForRole(self, params):
+        self.role(params['RoleName'])
+        return self.page(self.profilesForRole(params['RoleName']), params, 'InstanceProfiles')
+
+    '''
+    IAM changes
+    '''
+    def CreateRole(self, params):
+        roleName = params['RoleName']
+        if roleName in self.roles:
+            raise FixtureError(409, 'EntityAlreadyExists', 'Role with name %s already exists.' % roleName)
+        role = {
+            'Path': params.get('Path', '/'),
+            'RoleName': roleName,
+            'RoleId': 'AROAFIXTURE%08d' % len(self.roles),
+            'Arn': 'arn:aws:iam::%s:role%s%s' % (self.accountName(), params.get('Path', '/'), roleName),
+            'CreateDate': datetime.utcnow(),
+            'AssumeRolePolicyDocument': encodeDocument(decodeDocument(params['AssumeRolePolicyDocument'])),
+        }
+        self.roles[roleName] = role
+        self.attached[roleName] = []
+        return {'Role': role}
+
+    def DeleteRole(self, params):
+        roleName = self.role(params['RoleName'])['RoleName']
+        if len(self.attached[roleName]) > 0 or len(self.profilesForRole(roleName)) > 0:
+            raise FixtureError(409, 'DeleteConflict', 'Cannot delete entity, must detach all policies first.')
+        del self.roles[roleName]
+        del self.attached[roleName]
+        return {}
+
+    def AttachRolePolicy(self, params):
+        roleName = self.role(params['RoleName'])['RoleName']
+        policyArn = self.policy(params['PolicyArn'])['Arn']
+        if policyArn not in self.attached[roleName]:
+            self.attached[roleName].append(policyArn)
+        return {}
+
+    def DetachRolePolicy(self, params):
+        roleName = self.role(params['RoleName'])['RoleName']
+        if params['PolicyArn'] not in self.attached[roleName]:
+            raise FixtureError(404, 'NoSuchEntity', 'Policy %s was not found.' % params['PolicyArn'])
+        self.attached[roleName].remove(params['PolicyArn'])
+        return {}
+
+    def CreatePolicy(self, params):
+        policyName = params['PolicyName']
+        policyArn = 'arn:aws:iam::%s:policy%s%s' % (self.accountName(), params.get('Path', '/'), policyName)
+        if policyArn in self.policies:
+            raise FixtureError(409, 'EntityAlreadyExists', 'A policy called %s already exists.' % policyName)
+        now = datetime.utcnow()
+        meta = {
+            'PolicyName': policyName,
+            'PolicyId': 'ANPAFIXTURE%08d' % len(self.policies),
+            'Arn': policyArn,
+            'Path': params.get('Path', '/'),
+            'DefaultVersionId': 'v1',
+            'AttachmentCount': 0,
+            'IsAttachable': True,
+            'CreateDate': now,
+            'UpdateDate': now,
+        }
+        self.policies[policyArn] = meta
+        self.versions[policyArn] = OrderedDict([('v1', {
+            'Document': decodeDocument(params['PolicyDocument']),
+            'VersionId': 'v1',
+            'IsDefaultVersion': True,
+            'CreateDate': now,
+        })])
+        return {'Policy': meta}
+
+    def DeletePolicy(self, params):
+        policyArn = self.policy(params['PolicyArn'])['Arn']
+        for attached in self.attached.values():
+            if policyArn in attached:
+                raise FixtureError(409, 'DeleteConflict', 'Cannot delete a policy attached to entities.')
+        if len(self.versions[policyArn]) > 1:
+            raise FixtureError(409, 'DeleteConflict', 'Cannot delete a policy with non-default versions.')
+        del self.policies[policyArn]
+        del self.versions[policyArn]
+        return {}
+
+    def CreatePolicyVersion(self, params):
+        meta = self.policy(params['PolicyArn'])
+        versions = self.versions[meta['Arn']]
+        if len(versions) >= 5:
+            raise FixtureError(409, 'LimitExceeded', 'A managed policy can have up to 5 versions.')
+        number = max([int(versionId[1:]) for versionId in versions] + [0]) + 1
+        versionId = 'v%d' % number
+        now = datetime.utcnow()
+        setAsDefault = params.get('SetAsDefault', False)
+        if setAsDefault:
+            for version in versions.values():
+                version['IsDefaultVersion'] = False
+            meta['DefaultVersionId'] = versionId
+            meta['UpdateDate'] = now
+        versions[versionId] = {
+            'Document': decodeDocument(params['PolicyDocument']),
+            'VersionId': versionId,
+            'IsDefaultVersion': setAsDefault,
+            'CreateDate': now,
+        }
+        version = dict(versions[versionId])
+        del version['Document']
+        return {'PolicyVersion': version}
+
+    def DeletePolicyVersion(self, params):
+        meta = self.policy(params['PolicyArn'])
+        versions = self.versions[meta['Arn']]
+        if params['VersionId'] not in versions:
+            raise FixtureError(404, 'NoSuchEntity', 'Policy version %s does not exist.' % params['VersionId'])
+        if params['VersionId'] == meta['DefaultVersionId']:
+            raise FixtureError(409, 'DeleteConflict', 'Cannot delete the default version of a policy.')
+        del versions[params['VersionId']]
+        return {}
+
+    def CreateInstanceProfile(self, params):
+        profileName = params['InstanceProfileName']
+        if profileName in self.profiles:
+            raise FixtureError(409, 'EntityAlreadyExists', 'Instance Profile %s already exists.' % profileName)
+        profile = {
+            'Path': params.get('Path', '/'),
+            'InstanceProfileName': profileName,
+            'InstanceProfileId': 'AIPAFIXTURE%08d' % len(self.profiles),
+            'Arn': 'arn:aws:iam::%s:instance-profile%s%s' % (self.accountName(), params.get('Path', '/'), profileName),
+            'CreateDate': datetime.utcnow(),
+            'Roles': [],
+        }
+        self.profiles[profileName] = profile
+        return {'InstanceProfile': profile}
+
+    def DeleteInstanceProfile(self, params):
+        profile = self.profile(params['InstanceProfileName'])
+        if len(profile['Roles']) > 0:
+            raise FixtureError(409, 'DeleteConflict', 'Cannot delete entity, must remove roles from instance profile first.')
+        del self.profiles[profile['InstanceProfileName']]
+        return {}
+
+    def AddRoleToInstanceProfile(self, params):
+        profile = self.profile(params['InstanceProfileName'])
+        role = self.role(params['RoleName'])
+        if len(profile['Roles']) > 0:
+            raise FixtureError(409, 'LimitExceeded', 'Cannot exceed quota for InstanceSessionsPerInstanceProfile: 1')
+        profile['Roles'].append(role)
+        return {}
+
+    def RemoveRoleFromInstanceProfile(self, params):
+        profile = self.profile(params['InstanceProfileName'])
+        if not findRoleName(profile['Roles'], params['RoleName']):
+            raise FixtureError(404, 'NoSuchEntity', 'Role %s is not in the instance profile.' % params['RoleName'])
+        profile['Roles'] = [role for role in profile['Roles'] if role['RoleName'] != params['RoleName']]
+        return {}
+
+    '''
+    EC2 reads.  Only the filters this tool uses are understood: tags,
+    instance-state-name and iam-instance-profile.arn.
+    '''
+    def matchesFilters(self, instance, filters):
+        for instanceFilter in filters:
+            name = instanceFilter['Name']
+            values = instanceFilter['Values']
+            if name.startswith('tag:'):
+                tags = dict((tag['Key'], tag['Value']) for tag in instance.get('Tags') or [])
+                if tags.get(name[4:]) not in values:
+                    return False
+            elif name == 'instance-state-name':
+                if instance['State']['Name'] not in values:
+                    return False
+            elif name == 'iam-instance-profile.arn':
+                if instance.get('IamInstanceProfile', {}).get('Arn') not in values:
+                    return False
+        return True
+
+    def DescribeInstances(self, params):
+        filters = params.get('Filters', [])
+        reservations = []
+        for reservation in self.reservations:
+            instances = [instance for instance in reservation['Instances'] if self.matchesFilters(instance, filters)]
+            if len(instances) > 0:
+                reservation = dict(reservation)
+                reservation['Instances'] = instances
+                reservations.append(reservation)
+        start = int(params.get('NextToken') or 0)
+        size = params.get('MaxResults') or self.pageSize
+        response = {'Reservations': reservations[start:start + size]}
+        if start + size < len(reservations):
+            response['NextToken'] = str(start + size)
+        return response
+
+
+def installFixtureClients(ctx, spec):
+    fixtureDir, settings = parseBackend(spec)
+    backend = FixtureBackend(fixtureDir, **settings)
+    credentials = {'aws_access_key_id': 'fixtures', 'aws_secret_access_key': 'fixtures'}
+    ctx.iam = boto3.client('iam', region_name=ctx.region, **credentials)
+    ctx.ec2 = boto3.client('ec2', region_name=ctx.region, **credentials)
+    backend.install(ctx.iam)
+    backend.install(ctx.ec2)
+    ctx.backend = backend
+    return backend
@@ -7,60 +7,75 @@ import click
 from jinja2 import Template
 import utils.utils as utils
 from awsutils import roles as aws_roles
+from awsutils import paginate
 
 def getTag(ctx, tags, tagName):
+    if tags == None:
+        return None
     for tag in tags:
         if tag['Key'] == tagName:
             return tag['Value']
     return None
 
 
+def iterFilteredInstances(ctx, filters):
+    return paginate.iterate(ctx.ec2, 'describe_instances', 'Reservations[].Instances[]', Filters=filters)
+
+def profileIdOf(instance):
+    if 'IamInstanceProfile' in instance:
+        return instance['IamInstanceProfile']['Id']
+    return 'NO_INSTANCE_PROFILE'
+
 def getFilteredInstances(ctx, filters):
-    ec2 = ctx.ec2
     instances = []
     instancesByProfileId = {}
-    irs = ec2.describe_instances(Filters=filters)
-    for reservation in  irs['Reservations']:
-        for instance in reservation['Instances']:
-            #ctx.vlog('%s' % instance)
-            instances.append(instance)
-            id = 'NO_INSTANCE_PROFILE'
-            if 'IamInstanceProfile' in instance:
-                id = instance['IamInstanceProfile']['Id']
-            if id in instancesByProfileId:
-                instancesByProfileId[id].append(instance)
-            else:
-                instancesByProfileId[id] = []
-                instancesByProfileId[id].append(instance)
-    while 'NextToken' in irs:
-        irs = ec2.describe_instances(Filters=filters)
-        for reservation in  irs['Reservations']:
-            for instance in reservation['Instances']:
-                instances.append(instance)
-                id = 'NO_INSTANCE_PROFILE'
-                if 'IamInstanceProfile' in instance:
-                    id = instance['IamInstanceProfile']['Id']
-                if id in instancesByProfileId:
-                    instancesByProfileId[id].append(instance)
-                else:
-                    instancesByProfileId[id] = []
-                    instancesByProfileId[id].append(instance)
+    for instance in iterFilteredInstances(ctx, filters):
+        instances.append(instance)
+        id = profileIdOf(instance)
+        if id in instancesByProfileId:
+            instancesByProfileId[id].append(instance)
+        else:
+            instancesByProfileId[id] = []
+            instancesByProfileId[id].append(instance)
     return instances, instancesByProfileId
 
-
-
-def getInstances(ctx, region, env):
+def instanceFilters(region, env):
     filters = []
     if region != None:
         filters.append({'Name':'tag:Region', 'Values':['%s'%region]})
     if env != None:
         filters.append({'Name':'tag:Environment', 'Values':['%s'%env]})
-    ctx.nvlog('Getting ec2 instances...')
+    return filters
+
+
+
+def getInstances(ctx, region, env):
+    filters = instanceFilters(region, env)
+    ctx.vlog('Getting ec2 instances...', nl=False)
     instances, instancesByProfileId = getFilteredInstances(ctx, filters)
     ctx.vlog(' done')
     return instances, instancesByProfileId
 
 
+'''
+Every instance state except terminated.  Instances in these states still hold
+their instance profile, so the role in it must not be deleted.
+'''
+activeStates = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+
+def getActiveInstancesByProfileId(ctx):
+    '''
+    Non-terminated instances grouped by instance profile id, from a single
+    describe_instances pass that is kept for the rest of the run, so that
+    checking any number of roles before deleting them is a lookup.
+    '''
+    if ctx.activeInstancesByProfileId == None:
+        filters = [{'Name':'instance-state-name', 'Values':activeStates}]
+        ctx.vlog('Getting active ec2 instances...', nl=False)
+        _, ctx.activeInstancesByProfileId = getFilteredInstances(ctx, filters)
+        ctx.vlog(' done')
+    return ctx.activeInstancesByProfileId
+
 def getInstancesByIAMInstanceProfileId(ctx, instanceProfileArn):
     ec2 = ctx.ec2
     instances = []
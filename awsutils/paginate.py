@@ -0,0 +1,22 @@
+'''
+Shared pagination layer.  Every list call in awsutils goes through these
+generators, which are built on the boto3 paginators so that the Marker and
+NextToken handling is always right.  Entities are yielded one at a time as
+the pages arrive, so callers can stream through large accounts without
+holding whole listings in memory.
+'''
+
+def pages(client, operation, **kwargs):
+    paginator = client.get_paginator(operation)
+    for page in paginator.paginate(**kwargs):
+        yield page
+
+def iterate(client, operation, expression, **kwargs):
+    '''
+    Yields the entities selected by the JMESPath expression from every page,
+    e.g. 'Roles' or 'Reservations[].Instances[]'.
+    '''
+    paginator = client.get_paginator(operation)
+    for item in paginator.paginate(**kwargs).search(expression):
+        if item is not None:
+            yield item
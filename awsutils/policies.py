@@ -5,14 +5,19 @@ from botocore.exceptions import ClientError
 import json
 import click
 from jinja2 import Template
+from concurrent.futures import ThreadPoolExecutor
 import utils.utils as utils
 from awsutils import roles as aws_roles
+from awsutils import paginate
+from awsutils.records import ManagedPolicy
+from utils.instrument import spanned
 
 def guessIamArn(ctx, policyName):
     return 'arn:aws:iam::%s:policy/%s' % (ctx.orgId, policyName)
 
 def storePolicyMeta(ctx, meta):
-    ctx.awsPolicyMeta[meta['PolicyName']]=meta
+    ''' Stores the record of a policy, from its get_policy or list_policies shape '''
+    ctx.addPolicy(ManagedPolicy.fromResponse(meta))
 
 def storePolicyMetas(ctx, metas):
     for meta in metas:
@@ -26,13 +31,15 @@ def fetchPolicy(ctx, policyName):
         if mps == None:
             ctx.vlog('fetchPolicy: policy not found for %s (%s)' % policyName, policyArn)
         ctx.vlog('fetchPolicy: fetched meta for %s\n%s' % (policyName, mps))
-        ctx.awsPolicyMeta[policyName] = mps['Policy']
+        storePolicyMeta(ctx, mps['Policy'])
     except ClientError as err:
+        if err.response['Error']['Code'] != 'NoSuchEntity':
+            raise
         ctx.vlog('fetchPolicy: policy not found for %s (%s)' % (policyName, policyArn))
 
 
 def getPolicyMeta(ctx, policyName):
-    if policyName not in ctx.awsPolicyMeta:
+    if policyName not in ctx.awsPolicyMeta and not ctx.snapshotLoaded:
         ctx.vlog('getPolicyMeta: %s is not in cache.  Attempting to fetch' % policyName)
         fetchPolicy(ctx, policyName)
     if policyName not in ctx.awsPolicyMeta:
@@ -42,24 +49,74 @@ def getPolicyMeta(ctx, policyName):
 
 def getAllPolicies(ctx, env=None):
     iam = ctx.iam
-    mps = iam.list_policies(Scope='Local')
-    storePolicyMetas(ctx,mps['Policies'])
-    while mps['IsTruncated']:
-        mps = iam.list_policies(Scope='Local', Marker=mps['Marker'])
-        storePolicyMetas(ctx,mps['Policies'])
+    storePolicyMetas(ctx, paginate.iterate(iam, 'list_policies', 'Policies', Scope='Local'))
+
+'''
+Policy versions.  The version ids of a policy are kept in ctx.policyVersions,
+oldest first, whether they came from the account snapshot or from
+list_policy_versions, and are kept up to date as versions are created and
+deleted.  Version ids are v1, v2, ... and are ordered by number, so that v10
+comes after v9.
+'''
+# IAM keeps at most five versions of a managed policy
+MAX_VERSIONS = 5
+
+def versionNumber(versionId):
+    try:
+        return int(versionId.lstrip('v'))
+    except ValueError:
+        return 0
+
+def sortVersions(versionIds):
+    return sorted(versionIds, key=versionNumber)
 
 def getPolicyVersions(ctx, policyArn):
     iam = ctx.iam
+    if policyArn in ctx.policyVersions:
+        return list(ctx.policyVersions[policyArn])
     versions = []
-    mps = iam.list_policy_versions(PolicyArn = policyArn)
-    ctx.vlog('getPolicyVersions: received \n%s' % mps)
-    for version in mps['Versions']:
+    for version in paginate.iterate(iam, 'list_policy_versions', 'Versions', PolicyArn=policyArn):
         versions.append(version['VersionId'])
-    while mps['IsTruncated']:
-        mps = iam.list_policy_versions(PolicyArn = policyArn, Marker=mps['Marker'])
-        for version in mps['Versions']:
-            versions.append(version['VersionId'])
-    return versions
+    versions = sortVersions(versions)
+    ctx.vlog('getPolicyVersions: received %s' % versions)
+    ctx.policyVersions[policyArn] = versions
+    return list(versions)
+
+@spanned('prefetch')
+def prefetchPolicyVersions(ctx, policyArns):
+    ''' Lists the versions of every policy not already known, using ctx.workers threads '''
+    iam = ctx.iam
+    wanted = []
+    for policyArn in policyArns:
+        if policyArn not in ctx.policyVersions and policyArn not in wanted:
+            wanted.append(policyArn)
+    if len(wanted) == 0:
+        return
+
+    ctx.vlog('prefetchPolicyVersions: Listing the versions of %d policies with %d workers' % (len(wanted), ctx.workers))
+    with ThreadPoolExecutor(max_workers=ctx.workers) as pool:
+        futures = []
+        for policyArn in wanted:
+            # A policy has at most five versions, so they fit in a single page
+            futures.append(pool.submit(iam.list_policy_versions, PolicyArn=policyArn))
+        for policyArn, future in zip(wanted, futures):
+            versions = [version['VersionId'] for version in future.result()['Versions']]
+            ctx.policyVersions[policyArn] = sortVersions(versions)
+
+def versionsToPrune(versions, defaultVersionId, keepVersions):
+    '''
+    The oldest versions to delete before a new default version is created, so
+    that keepVersions versions remain once it is, the new one included.  The
+    current default version is never deleted.
+    '''
+    excess = len(versions) + 1 - keepVersions
+    prune = []
+    for versionId in sortVersions(versions):
+        if len(prune) >= excess:
+            break
+        if versionId != defaultVersionId:
+            prune.append(versionId)
+    return prune
 
 def createPolicyVersion(ctx, policyArn, policyDocument):
     iam = ctx.iam
@@ -68,8 +125,19 @@ def createPolicyVersion(ctx, policyArn, policyDocument):
         return
     mps = iam.create_policy_version(PolicyArn=policyArn, PolicyDocument=policyDocument,SetAsDefault=True)
     ctx.audit('Created new default policy version for policy %s: %s' % (policyArn, policyDocument))
-    policyName = utils.policyNameFromArn(ctx, policyArn)
-    getDefaultPolicyVersion(ctx, policyName)
+    versionId = mps['PolicyVersion']['VersionId']
+    meta = ctx.getPolicyByArn(policyArn)
+    if meta != None:
+        policyName = meta.policyName
+        ctx.addPolicy(meta.withDefaultVersion(versionId))
+    else:
+        policyName = utils.policyNameFromArn(ctx, policyArn)
+    if policyArn in ctx.policyVersions:
+        ctx.policyVersions[policyArn].append(versionId)
+    ctx.awsPolicyDocs[policyName] = json.loads(policyDocument)
+    if ctx.cache != None:
+        ctx.cache.putDocument(ctx.orgId, policyArn, versionId, ctx.awsPolicyDocs[policyName])
+        ctx.cache.commit()
 
 def deletePolicyVersion(ctx, policyArn, versionId):
     iam = ctx.iam
@@ -78,6 +146,8 @@ def deletePolicyVersion(ctx, policyArn, versionId):
         return
     iam.delete_policy_version(PolicyArn=policyArn,VersionId=versionId)
     ctx.audit('Deleted policy version %s from %s' % (versionId, policyArn))
+    if policyArn in ctx.policyVersions and versionId in ctx.policyVersions[policyArn]:
+        ctx.policyVersions[policyArn].remove(versionId)
 
 
 def getDefaultPolicyVersion(ctx, policyName):
@@ -91,14 +161,44 @@ def getDefaultPolicyVersion(ctx, policyName):
         return ctx.awsPolicyDocs[policyName]
 
     ctx.vlog('getDefaultPolicyVersion: Getting policy document from AWS')
-    policyArn = meta['Arn']
-    versionId = meta['DefaultVersionId']
+    policyArn = meta.arn
+    versionId = meta.defaultVersionId
     mps = iam.get_policy_version(PolicyArn=policyArn, VersionId=versionId)
     policyDoc = mps['PolicyVersion']['Document']
     ctx.awsPolicyDocs[policyName] = policyDoc
     return policyDoc
 
 
+'''
+Fetches the default version document of every named policy that is not
+already in ctx.awsPolicyDocs, using a pool of ctx.workers threads.  Results
+are stored in the order the names were given.
+'''
+@spanned('prefetch')
+def prefetchPolicyDocuments(ctx, policyNames):
+    iam = ctx.iam
+    wanted = []
+    seen = set()
+    for policyName in policyNames:
+        if policyName in ctx.awsPolicyDocs or policyName in seen:
+            continue
+        seen.add(policyName)
+        meta = getPolicyMeta(ctx, policyName)
+        if meta == None:
+            continue
+        wanted.append((policyName, meta.arn, meta.defaultVersionId))
+    if len(wanted) == 0:
+        return
+
+    ctx.vlog('prefetchPolicyDocuments: Fetching %d policy documents with %d workers' % (len(wanted), ctx.workers))
+    with ThreadPoolExecutor(max_workers=ctx.workers) as pool:
+        futures = []
+        for policyName, policyArn, versionId in wanted:
+            futures.append(pool.submit(iam.get_policy_version, PolicyArn=policyArn, VersionId=versionId))
+        for entry, future in zip(wanted, futures):
+            ctx.awsPolicyDocs[entry[0]] = future.result()['PolicyVersion']['Document']
+
+
 def deletePolicy(ctx, policyName):
     iam = ctx.iam
     meta = getPolicyMeta(ctx, policyName)
@@ -106,24 +206,16 @@ def deletePolicy(ctx, policyName):
         # Nothing to do
         ctx.vlog('deletePolicy: policy %s does not exist' % policyName)
         return
-    policyArn = meta['Arn']
-    defaultVersionId = meta['DefaultVersionId']
+    policyArn = meta.arn
+    defaultVersionId = meta.defaultVersionId
 
     #detach from Roles
-    #try:
-    mps = iam.list_entities_for_policy(PolicyArn=policyArn, EntityFilter='Role')
-    # {'PolicyUsers': [], 'ResponseMetadata': {'HTTPStatusCode': 200, 'RequestId': '15a1da6e-83eb-11e5-95da-2d6fbedc8b89'}, 'PolicyGroups': [], 'IsTruncated': False, 'PolicyRoles': [{'RoleName': 'us-west-2-dev-mongo'}]}
-
-    for policyRole in mps['PolicyRoles']:
-        roleName = policyRole['RoleName']
-        aws_roles.detachPolicy(ctx, roleName, policyName)
-
-    while mps['IsTruncated']:
-        mps = iam.list_entities_for_policy(PolicyArn=policyArn, EntityFilter='Role', Marker=mps['Marker'])
-        for policyRole in mps['PolicyRoles']:
-            aws_roles.detachPolicy(ctx, policyRole['RoleName'], policyName)
-    #except:
-    #    pass
+    if ctx.snapshotLoaded:
+        for roleName in list(ctx.attachedPolicies):
+            if policyName in ctx.attachedPolicies[roleName]:
+                aws_roles.detachPolicy(ctx, roleName, policyName)
+    else:
+        detachFromAllRoles(ctx, policyName, policyArn)
 
     # delete all Versions except Default
     versions = getPolicyVersions(ctx, policyArn)
@@ -137,6 +229,17 @@ def deletePolicy(ctx, policyName):
         return
     iam.delete_policy(PolicyArn=policyArn)
     ctx.audit('Deleted policy %s' % (policyName))
+    ctx.removePolicy(policyName)
+
+def detachFromAllRoles(ctx, policyName, policyArn):
+    iam = ctx.iam
+    # {'PolicyUsers': [], 'ResponseMetadata': {'HTTPStatusCode': 200, 'RequestId': '15a1da6e-83eb-11e5-95da-2d6fbedc8b89'}, 'PolicyGroups': [], 'IsTruncated': False, 'PolicyRoles': [{'RoleName': 'us-west-2-dev-mongo'}]}
+    # Collect the roles first, so that detaching does not shift the pages
+    roleNames = []
+    for policyRole in paginate.iterate(iam, 'list_entities_for_policy', 'PolicyRoles', PolicyArn=policyArn, EntityFilter='Role'):
+        roleNames.append(policyRole['RoleName'])
+    for roleName in roleNames:
+        aws_roles.detachPolicy(ctx, roleName, policyName)
 
 def createPolicy(ctx, policyName, policyDocument):
     ctx.vlog('iam.create_policy(PolicyName=%s, PolicyDocument=%s)'%(policyName, policyDocument))
@@ -149,5 +252,6 @@ def createPolicy(ctx, policyName, policyDocument):
     if mps['ResponseMetadata']['HTTPStatusCode'] == 200:
         ctx.vlog('Policy created: %s' % mps['Policy']['Arn'])
         storePolicyMeta(ctx, mps['Policy'])
-        getDefaultPolicyVersion(ctx, mps['Policy']['PolicyName'])
+        ctx.awsPolicyDocs[policyName] = json.loads(policyDocument)
+        ctx.policyVersions[mps['Policy']['Arn']] = [mps['Policy']['DefaultVersionId']]
     ctx.vlog(mps)
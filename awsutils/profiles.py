@@ -7,42 +7,59 @@ import click
 from jinja2 import Template
 import utils.utils as utils
 from awsutils import roles as aws_roles
+from awsutils import paginate
+from awsutils.records import InstanceProfile
 
 def getInstanceProfilesForRoleName(ctx, roleName):
     iam = ctx.iam
     instanceProfiles = []
     instanceProfileByProfileId = {}
-    mps = iam.list_instance_profiles_for_role(RoleName=roleName)
-    for profile in mps['InstanceProfiles']:
-        instanceProfiles.append(profile)
-        instanceProfileByProfileId[profile['InstanceProfileId']] = profile
-    while mps['IsTruncated'] == True:
-        mps = iam.list_instance_profiles_for_role(RoleName=roleName, Marker=mps['Marker'])
-        for profile in mps['InstanceProfiles']:
+    if ctx.snapshotLoaded:
+        for profile in ctx.getInstanceProfilesForRole(roleName):
             instanceProfiles.append(profile)
-            instanceProfileByProfileId[profile['InstanceProfileId']] = profile
+            instanceProfileByProfileId[profile.profileId] = profile
+        return instanceProfiles, instanceProfileByProfileId
+    for profile in paginate.iterate(iam, 'list_instance_profiles_for_role', 'InstanceProfiles', RoleName=roleName):
+        profile = InstanceProfile.fromResponse(profile)
+        instanceProfiles.append(profile)
+        instanceProfileByProfileId[profile.profileId] = profile
     return instanceProfiles, instanceProfileByProfileId
 
-def getAllInstanceProfiles(ctx):
+def getInstanceProfile(ctx, profileName):
     iam = ctx.iam
+    try:
+        mps = iam.get_instance_profile(InstanceProfileName=profileName)
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'NoSuchEntity':
+            raise
+        ctx.vlog('getInstanceProfile: profile %s was not found in AWS' % profileName)
+        return [], {}
+    profile = InstanceProfile.fromResponse(mps['InstanceProfile'])
+    return [profile], {profile.profileId: profile}
+
+def iterInstanceProfiles(ctx):
+    if ctx.snapshotLoaded:
+        return iter(list(ctx.instanceProfiles.values()))
+    profiles = paginate.iterate(ctx.iam, 'list_instance_profiles', 'InstanceProfiles')
+    return (InstanceProfile.fromResponse(profile) for profile in profiles)
+
+def getAllInstanceProfiles(ctx):
     instanceProfiles = []
     instanceProfileByProfileId = {}
-    mps = iam.list_instance_profiles()
-    for profile in mps['InstanceProfiles']:
+    for profile in iterInstanceProfiles(ctx):
         instanceProfiles.append(profile)
-        instanceProfileByProfileId[profile['InstanceProfileId']] = profile
-    while mps['IsTruncated']:
-        iam.list_instance_profiles( Marker=mps['Marker'])
-        for profile in mps['InstanceProfiles']:
-            instanceProfiles.append(profile)
-            instanceProfileByProfileId[profile['InstanceProfileId']] = profile
+        instanceProfileByProfileId[profile.profileId] = profile
     return instanceProfiles, instanceProfileByProfileId
 
 
 def deleteInstanceProfile(ctx, profileName):
     iam = ctx.iam
+    if ctx.dry_run:
+        ctx.log('iam.delete_instance_profile(InstanceProfileName=%s)' % profileName)
+        return
     iam.delete_instance_profile(InstanceProfileName=profileName)
     ctx.audit('Deleted instance profile: %s' % profileName)
+    ctx.removeInstanceProfile(profileName)
 
 
 '''
@@ -53,5 +70,9 @@ a running instance will break any applications running on the instance.
 '''
 def removeRoleFromProfile(ctx, roleName, profileName):
     iam = ctx.iam
+    if ctx.dry_run:
+        ctx.log('iam.remove_role_from_instance_profile(InstanceProfileName=%s, RoleName=%s)' % (profileName, roleName))
+        return
     iam.remove_role_from_instance_profile(InstanceProfileName=profileName, RoleName=roleName)
     ctx.audit('Removed role %s from instance: %s' % (roleName, profileName))
+    ctx.removeRoleFromInstanceProfile(roleName, profileName)
@@ -0,0 +1,172 @@
+import time
+import threading
+from collections import OrderedDict
+from awsutils.retry import throttleCodes
+
+'''
+Client side rate limiting shared by every IAM and EC2 call.
+
+IAM throttles per account, not per client, so the calls of all threads share
+one token bucket per service and budget.  Reads (Get, List and Describe
+calls) and mutations have separate budgets, since AWS allows far fewer
+mutations than reads.
+
+Each bucket adapts its rate with AIMD: a throttled call, or a call that the
+SDK only completed after retrying, halves the rate, and every successful call
+raises it a little, so the rate settles just under what the account
+sustains.  Rates start at the configured budget and may grow to
+RATE_CEILING times it.  The time callers spent waiting for a token is
+counted per bucket and reported by the profile.
+
+A token is taken for every attempt, not every call, so the retries of the
+SDK are limited too.  The limiter is installed on a client with install():
+the bucket of a call is chosen on botocore's before-parameter-build event,
+and a token is taken on before-send, which botocore emits for each attempt.
+A backend that answers calls without sending them, like the fixtures, takes
+its tokens with acquireAttempt().  The time spent waiting is kept in the call
+context, so that the instrumentation does not count it as call latency.
+'''
+
+DEFAULT_RATES = {'read': 20.0, 'mutation': 5.0}
+RATE_CEILING = 4.0
+MIN_RATE = 0.5
+# Rate added per second of successful calls
+INCREASE = 1.0
+DECREASE = 0.5
+# A burst of throttles from calls already in flight counts as one
+DECREASE_INTERVAL = 1.0
+
+readPrefixes = ('Get', 'List', 'Describe')
+
+def parseRates(spec):
+    ''' Returns the budgets of a 'read=20,mutation=5' spec '''
+    rates = dict(DEFAULT_RATES)
+    for part in spec.split(','):
+        if part == '':
+            continue
+        name, _, value = part.partition('=')
+        if name not in rates:
+            raise ValueError('unknown rate limit %s' % name)
+        rates[name] = float(value)
+        if rates[name] <= 0:
+            raise ValueError('rate limit %s must be positive' % name)
+    return rates
+
+def budgetOf(operation):
+    if operation.startswith(readPrefixes):
+        return 'read'
+    return 'mutation'
+
+def acquireAttempt(context):
+    ''' Takes a token for an attempt of the call with this context, if it is rate limited '''
+    bucket = context.get('rateLimitBucket')
+    if bucket == None:
+        return
+    context['rateLimitWait'] = context.get('rateLimitWait', 0.0) + bucket.acquire()
+
+
+class TokenBucket(object):
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.maxRate = rate * RATE_CEILING
+        self.burst = max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lastDecrease = 0.0
+        self.calls = 0
+        self.throttles = 0
+        self.waits = 0
+        self.waitSeconds = 0.0
+        self.lowestRate = rate
+
+    def acquire(self):
+        ''' Takes a token, sleeping until it is due, and returns the seconds waited '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # The token is taken now even when it is not there yet, which
+            # queues the callers in arrival order
+            self.tokens -= 1
+            wait = 0.0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+                self.waits += 1
+                self.waitSeconds += wait
+            self.calls += 1
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + INCREASE / self.rate)
+
+    def throttled(self):
+        with self.lock:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self.lastDecrease < DECREASE_INTERVAL:
+                return
+            self.lastDecrease = now
+            self.rate = max(MIN_RATE, self.rate * DECREASE)
+            self.lowestRate = min(self.lowestRate, self.rate)
+
+    def report(self):
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'throttles': self.throttles,
+                'waits': self.waits,
+                'waitSeconds': round(self.waitSeconds, 6),
+                'rate': round(self.rate, 3),
+                'lowestRate': round(self.lowestRate, 3),
+            }
+
+
+class RateLimiter(object):
+    def __init__(self, rates=None):
+        if rates == None:
+            rates = DEFAULT_RATES
+        self.rates = dict(rates)
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+
+    def bucket(self, service, budget):
+        key = '%s.%s' % (service, budget)
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self.rates[budget])
+            return self.buckets[key]
+
+    def install(self, client):
+        events = client.meta.events
+        events.register_first('before-parameter-build', self.beforeCall)
+        events.register('before-send', self.beforeSend)
+        events.register('after-call', self.afterCall)
+
+    def bucketOf(self, model):
+        return self.bucket(model.service_model.endpoint_prefix, budgetOf(model.name))
+
+    def beforeCall(self, model, context, **kwargs):
+        context['rateLimitBucket'] = self.bucketOf(model)
+
+    def beforeSend(self, request, **kwargs):
+        acquireAttempt(request.context)
+
+    def afterCall(self, parsed, model, **kwargs):
+        code = parsed.get('Error', {}).get('Code')
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if code in throttleCodes or retries > 0:
+            self.bucketOf(model).throttled()
+        elif code == None:
+            self.bucketOf(model).succeeded()
+
+    def report(self):
+        with self.lock:
+            buckets = list(self.buckets.items())
+        return OrderedDict((key, bucket.report()) for key, bucket in buckets)
+
+    def waitSeconds(self):
+        return sum(stats['waitSeconds'] for stats in self.report().values())
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import utils.utils as utils
+import utils.cache as cache
+
+'''
+Compact records of the IAM entities held in CSMContext.
+
+AWS responses carry far more than the tool uses: a role comes with its
+assume role policy document, and an instance profile with a full copy of
+each of its roles.  Responses are turned into these records as they are
+read, keeping only the fields the tool uses, and the region, env and role
+(or service) of the name are parsed once, when the record is made.  Names
+that do not follow the model have no region or env.
+
+A record is not changed once it is made; a change to an entity stores a new
+record for it.  asDict() returns the record in the shape of the AWS
+response, which is how the records are kept in the state cache.
+'''
+
+class Role(object):
+    __slots__ = ('roleName', 'path', 'arn', 'roleId', 'region', 'env', 'role')
+
+    def __init__(self, roleName, path='/', arn=None, roleId=None):
+        self.roleName = roleName
+        self.region, self.env, self.role = utils.regionEnvAndRole(roleName)
+        if path == '/' and self.region != None:
+            # Roles of the model that were made at the root are filed
+            # under the path that their name implies
+            _, path = utils.nameAndPath(self.region, self.env, self.role)
+        self.path = path
+        self.arn = arn
+        self.roleId = roleId
+
+    @classmethod
+    def fromResponse(cls, data):
+        return cls(data['RoleName'], data.get('Path', '/'), data.get('Arn'), data.get('RoleId'))
+
+    def asDict(self):
+        return OrderedDict([('RoleName', self.roleName), ('Path', self.path),
+            ('Arn', self.arn), ('RoleId', self.roleId)])
+
+
+class ManagedPolicy(object):
+    __slots__ = ('policyName', 'arn', 'defaultVersionId', 'attachmentCount', 'updateDate',
+        'region', 'env', 'service')
+
+    def __init__(self, policyName, arn, defaultVersionId=None, attachmentCount=0, updateDate=None):
+        self.policyName = policyName
+        self.region, self.env, self.service = utils.regionEnvAndRole(policyName)
+        self.arn = arn
+        self.defaultVersionId = defaultVersionId
+        self.attachmentCount = attachmentCount
+        self.updateDate = updateDate
+
+    @classmethod
+    def fromResponse(cls, data):
+        return cls(data['PolicyName'], data['Arn'], data.get('DefaultVersionId'),
+            data.get('AttachmentCount', 0), cache.updateDate(data))
+
+    def withDefaultVersion(self, versionId):
+        return ManagedPolicy(self.policyName, self.arn, versionId, self.attachmentCount, self.updateDate)
+
+    def asDict(self):
+        return OrderedDict([('PolicyName', self.policyName), ('Arn', self.arn),
+            ('DefaultVersionId', self.defaultVersionId), ('AttachmentCount', self.attachmentCount),
+            ('UpdateDate', self.updateDate)])
+
+
+class InstanceProfile(object):
+    __slots__ = ('profileName', 'profileId', 'arn', 'roleNames', 'region', 'env', 'role')
+
+    def __init__(self, profileName, profileId, arn=None, roleNames=()):
+        self.profileName = profileName
+        self.region, self.env, self.role = utils.regionEnvAndRole(profileName)
+        self.profileId = profileId
+        self.arn = arn
+        self.roleNames = tuple(roleNames)
+
+    @classmethod
+    def fromResponse(cls, data):
+        return cls(data['InstanceProfileName'], data['InstanceProfileId'], data.get('Arn'),
+            [role['RoleName'] for role in data.get('Roles', [])])
+
+    def withoutRole(self, roleName):
+        return InstanceProfile(self.profileName, self.profileId, self.arn,
+            [name for name in self.roleNames if name != roleName])
+
+    def asDict(self):
+        return OrderedDict([('InstanceProfileName', self.profileName), ('InstanceProfileId', self.profileId),
+            ('Arn', self.arn), ('Roles', [{'RoleName': roleName} for roleName in self.roleNames])])
@@ -0,0 +1,3 @@
+# Error codes with which AWS refuses a call for exceeding its rate
+throttleCodes = set(['Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'RequestThrottled'])
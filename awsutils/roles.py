@@ -2,40 +2,46 @@ import sys
 import os.path
 import boto3
 import json
+from botocore.exceptions import ClientError
 import utils.utils as utils
 import awsutils.policies as aws_policies
 import awsutils.instances as aws_instances
 import awsutils.profiles as aws_profiles
+from awsutils import paginate
+from awsutils.records import Role, InstanceProfile
 
 
 def getAllRoles(ctx):
     iam = ctx.iam
     if ctx.env == None:
-        mps = iam.list_roles()
+        roles = paginate.iterate(iam, 'list_roles', 'Roles')
     else:
-        mps = iam.list_roles(PathPrefix='/%s/%s' % (ctx.region, ctx.env))
-
-    ctx.currentRoles.extend(mps['Roles'])
-    while mps['IsTruncated']:
-        mps = iam.list_roles( Marker=mps['Marker'])
-        ctx.currentRoles.extend(mps['Roles'])
-
-    for role in ctx.currentRoles:
-        if role['Path'] == '/':
-            try:
-                region,env,rolePart = utils.regionEnvAndRole(role['RoleName'])
-                _,path = utils.nameAndPath(region, env, rolePart)
-                role['Path'] = path
-            except:
-                pass
+        roles = paginate.iterate(iam, 'list_roles', 'Roles', PathPrefix='/%s/%s' % (ctx.region, ctx.env))
+
+    for role in roles:
+        ctx.addRole(Role.fromResponse(role))
+
+def fetchRole(ctx, roleName):
+    iam = ctx.iam
+    try:
+        mps = iam.get_role(RoleName=roleName)
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'NoSuchEntity':
+            raise
+        ctx.vlog('fetchRole: role %s was not found in AWS' % roleName)
+        return None
+    role = Role.fromResponse(mps['Role'])
+    ctx.addRole(role)
+    ctx.attachedPolicies[roleName] = getAttachedPolicies(ctx, roleName)
+    return role
 
 def getAttachedPolicies(ctx, roleName):
     iam = ctx.iam
+    if roleName in ctx.attachedPolicies:
+        return list(ctx.attachedPolicies[roleName])
     attached = []
-    policies = iam.list_attached_role_policies(RoleName=roleName)['AttachedPolicies']
-    if len(policies) != 0:
-        for policy in policies:
-            attached.append(policy['PolicyName'])
+    for policy in paginate.iterate(iam, 'list_attached_role_policies', 'AttachedPolicies', RoleName=roleName):
+        attached.append(policy['PolicyName'])
     return attached
 
 def attachPolicy(ctx, roleName, policyName):
@@ -44,13 +50,15 @@ def attachPolicy(ctx, roleName, policyName):
     if meta == None:
         ctx.log('attachPolicy: Error- %s does not exist in cached AWS policies' % policyName)
         return
-    policyArn = meta['Arn']
+    policyArn = meta.arn
     if ctx.dry_run:
         ctx.log('iam.attach_role_policy(RoleName=%s, PolicyArn=%s)' % (
             roleName, policyArn))
     else:
         msp = iam.attach_role_policy(RoleName=roleName, PolicyArn=policyArn)
         ctx.audit('Attached policy %s to role %s' % (policyName, roleName))
+        if roleName in ctx.attachedPolicies:
+            ctx.attachedPolicies[roleName].append(policyName)
 
 def detachPolicy(ctx, roleName, policyName):
     iam = ctx.iam
@@ -58,12 +66,14 @@ def detachPolicy(ctx, roleName, policyName):
     if meta == None:
         ctx.log('detachPolicy: Error- %s does not exist in cached AWS policies' % policyName)
         return
-    policyArn = meta['Arn']
+    policyArn = meta.arn
     if ctx.dry_run:
         ctx.log('iam.detach_role_policy(RoleName=%s, PolicyArn=%s)' % (roleName, policyArn))
     else:
         msp = iam.detach_role_policy(RoleName=roleName, PolicyArn=policyArn)
         ctx.audit('Detached policy %s from role %s' % (policyName, roleName) )
+        if roleName in ctx.attachedPolicies and policyName in ctx.attachedPolicies[roleName]:
+            ctx.attachedPolicies[roleName].remove(policyName)
 
 
 def detachAllPolicies(ctx, roleName):
@@ -78,15 +88,13 @@ def deleteRole(ctx, roleName):
     # then deleting it will likely break the running instance.
     instanceProfiles,_ = aws_profiles.getInstanceProfilesForRoleName(ctx, roleName)
     inUses = []
+    activeInstances = aws_instances.getActiveInstancesByProfileId(ctx)
     for instanceProfile in instanceProfiles:
-        instanceProfileId = instanceProfile['InstanceProfileId']
-        instances, instancesByProfileId = aws_instances.getInstancesByIAMInstanceProfileId(ctx, instanceProfile['Arn'])
-        for instance in instances:
-
-                        fullName = aws_instances.getTag(ctx, instance['Tags'], 'FullName')
-                        state = instance['State']['Name']
-                        if state != 'terminated':
-                            inUses.append({'fullName':fullName,'state':state, 'profileId':instanceProfileId})
+        instanceProfileId = instanceProfile.profileId
+        for instance in activeInstances.get(instanceProfileId, []):
+            fullName = aws_instances.getTag(ctx, instance.get('Tags'), 'FullName')
+            state = instance['State']['Name']
+            inUses.append({'fullName':fullName,'state':state, 'profileId':instanceProfileId})
     if len(inUses) > 0:
         ctx.log('Error:  Cannot delete role %s.  The following active instances are attached: ' % (roleName))
         for entry in inUses:
@@ -95,30 +103,27 @@ def deleteRole(ctx, roleName):
         return
 
     for instanceProfile in instanceProfiles:
-        instanceProfileName = instanceProfile['InstanceProfileName']
+        instanceProfileName = instanceProfile.profileName
         aws_profiles.removeRoleFromProfile(ctx, roleName, instanceProfileName)
         aws_profiles.deleteInstanceProfile(ctx, instanceProfileName)
 
     detachAllPolicies(ctx,roleName)
     if ctx.dry_run:
-        ctx.log('iam.delete_role(RoleName=roleName)' % (roleName))
+        ctx.log('iam.delete_role(RoleName=%s)' % (roleName))
     else:
         iam.delete_role(RoleName=roleName)
         ctx.audit('Deleted role: %s' % roleName)
+        ctx.removeRole(roleName)
 
 def createRole(ctx, roleName):
     iam = ctx.iam
-    if ctx.currentRoles == None:
-        ctx.vlog('createRole:  Roles must be fetched first')
-        return
-
     assumeRolePolicyDocument = '{"Statement": [{"Action": "sts:AssumeRole", "Principal": {"Service": "ec2.amazonaws.com"}, "Sid": "", "Effect": "Allow"}], "Version": "2012-10-17"}'
+    region, env, role = utils.regionEnvAndRole(roleName)
+    path = '/%s/%s/%s/' % (region, env,role)
     if ctx.dry_run:
         ctx.log('create_role(Path=%s, RoleName=%s,AssumeRolePolicyDocument=%s)' % (path, roleName, assumeRolePolicyDocument))
         return
     # Create roles
-    region, env, role = utils.regionEnvAndRole(roleName)
-    path = '/%s/%s/%s/' % (region, env,role)
     # Attach role to instance profile
     msp = iam.create_role(Path=path, RoleName=roleName, AssumeRolePolicyDocument=assumeRolePolicyDocument)
     if msp['ResponseMetadata']['HTTPStatusCode'] != 200:
@@ -139,13 +144,11 @@ def createRole(ctx, roleName):
     ctx.audit('Attached role %s to instance profile: %s' % (roleName, roleName))
 
     ctx.vlog('Role created: %s' % msp['Role']['Arn'])
-    ctx.currentRoles.append(msp['Role'])
+    ctx.addRole(Role.fromResponse(msp['Role']))
+    ctx.attachedPolicies[roleName] = []
+    instanceProfile = msp2['InstanceProfile']
+    ctx.addInstanceProfile(InstanceProfile(instanceProfile['InstanceProfileName'],
+        instanceProfile['InstanceProfileId'], instanceProfile.get('Arn'), [roleName]))
 
 def isRoleInAWS(ctx, roleName):
-    if ctx.currentRoles == None:
-        ctx.log('isRoleInAWS: Roles must be fetched first')
-        return False
-    for role in ctx.currentRoles:
-        if role['RoleName'] == roleName:
-            return True
-    return False
+    return ctx.getRole(roleName) != None
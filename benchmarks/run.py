@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import tracemalloc
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+from datetime import datetime
+import click
+import utils.utils as utils
+import awsutils.account as aws_account
+import csmutils.policies as csm_policies
+import csmutils.roles as csm_roles
+from utils.cache import defaultCacheDir
+from benchmarks import synthetic
+
+'''
+Benchmarks for model load, render, compare and reconcile.
+
+Each scale runs in a fresh process against a synthetic account served by the
+fixtures backend, so no AWS access is needed and runs are repeatable.  Every
+phase reports its wall time, the AWS calls it made, and its peak traced
+memory.  The results are written as JSON so that runs can be compared over
+time:
+
+    python -m benchmarks.run --scales 10,100,1000 --output bench.json
+'''
+
+RESULTS_VERSION = 1
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_DIR = os.path.join(REPO_DIR, 'policy_templates')
+
+class PhaseTimer(object):
+    def __init__(self, ctx, traceMemory):
+        self.ctx = ctx
+        self.traceMemory = traceMemory
+        self.phases = []
+
+    def calls(self):
+        return Counter(self.ctx.backend.serviceCalls), Counter(self.ctx.backend.calls)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        serviceCalls, calls = self.calls()
+        if self.traceMemory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+                yield
+        seconds = time.perf_counter() - start
+        serviceCallsAfter, callsAfter = self.calls()
+        result = {
+            'name': name,
+            'seconds': round(seconds, 6),
+            'calls': dict(serviceCallsAfter - serviceCalls),
+            'operations': dict(callsAfter - calls),
+        }
+        if self.traceMemory:
+            result['peakBytes'] = tracemalloc.get_traced_memory()[1]
+        self.phases.append(result)
+
+def renderAll(ctx):
+    for policyName in ctx.modelPolicies:
+        ctx.modelPolicies[policyName]
+
+def runScale(scale, workDir, backendSettings, workers, traceMemory, regenerate, renderProcesses):
+    modelDir, fixturesDir = synthetic.generate(workDir, scale, TEMPLATE_DIR, regenerate)
+    if traceMemory:
+        tracemalloc.start()
+
+    ctx = synthetic.modelContext(modelDir, TEMPLATE_DIR)
+    ctx.workers = workers
+    ctx.renderProcesses = renderProcesses
+    ctx.setFixtureClients('fixtures:%s%s' % (fixturesDir, backendSettings))
+    timer = PhaseTimer(ctx, traceMemory)
+    start = time.perf_counter()
+
+    with timer.phase('loadTemplates'):
+        ctx.templates = utils.loadPolicyTemplates(ctx)
+    with timer.phase('loadModel'):
+        ctx.model = utils.loadModel(ctx)
+    with timer.phase('loadModelPolicies'):
+        ctx.modelPolicies = utils.loadModelPolicies(ctx)
+    with timer.phase('render'):
+        renderAll(ctx)
+    with timer.phase('loadSnapshot'):
+        aws_account.loadSnapshot(ctx)
+    with timer.phase('comparePolicies'):
+        csm_policies.compareAllPolicies(ctx, None, None, None, None, False, 'unified', 0)
+    with timer.phase('compareRoles'):
+        csm_roles.compareModelRoles(ctx, None, None, None, False, False, 'unified', 0)
+    with timer.phase('reconcilePolicies'):
+        csm_policies.updatePolicies(ctx, None, None, None, None, True, False)
+    with timer.phase('reconcileRoles'):
+        csm_roles.updateRoles(ctx, None, None, None, True)
+
+    result = {
+        'scale': scale,
+        'modelRoles': sum(len(roles) for envs in ctx.model['roles'].values() for roles in envs.values()),
+        'modelPolicies': len(ctx.modelPolicies),
+        'seconds': round(time.perf_counter() - start, 6),
+        'calls': dict(ctx.backend.serviceCalls),
+        'throttles': ctx.backend.throttles,
+        'maxRssKb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'phases': timer.phases,
+        'operations': ctx.instrumentation.report()['operations'],
+    }
+    if traceMemory:
+        result['peakBytes'] = max(phase['peakBytes'] for phase in timer.phases)
+        tracemalloc.stop()
+    return result
+
+def runInProcess(*args):
+    # A fresh process per scale keeps the template caches of one scale from
+    # flattering the next.  Its workers, unlike a Pool's, may start the
+    # processes of --render_processes.
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(runScale, *args).result()
+
+def backendSettings(latency, throttle, page_size):
+    settings = ''
+    if latency > 0:
+        settings += ',latency=%s' % latency
+    if throttle > 0:
+        settings += ',throttle=%s' % throttle
+    if page_size != None:
+        settings += ',page_size=%d' % page_size
+    return settings
+
+def printSummary(results):
+    for result in results:
+        click.echo('scale %d: %d model roles, %d model policies, %.3fs, calls %s' % (
+            result['scale'], result['modelRoles'], result['modelPolicies'], result['seconds'],
+            ', '.join('%s=%d' % item for item in sorted(result['calls'].items()))), err=True)
+        for phase in result['phases']:
+            peak = ''
+            if 'peakBytes' in phase:
+                peak = '%10.1f MiB' % (phase['peakBytes'] / 1048576.0)
+            click.echo('    %-20s %10.3fs %8d calls%s' % (
+                phase['name'], phase['seconds'], sum(phase['calls'].values()), peak), err=True)
+
+@click.command()
+@click.option('--scales', default='10,100,1000,10000', help='Comma separated numbers of model roles')
+@click.option('--output', default='benchmark-results.json', help='File to write the JSON results to')
+@click.option('--work_dir', default=os.path.join(defaultCacheDir(), 'benchmarks'),
+              help='Directory for the generated models and fixtures')
+@click.option('--regenerate', is_flag=True, default=False, help='Generate the models and fixtures again')
+@click.option('--workers', type=click.IntRange(1, 64), default=8, help='Number of concurrent AWS requests')
+@click.option('--latency', type=click.FLOAT, default=0.0, help='Seconds added to every AWS call')
+@click.option('--throttle', type=click.FLOAT, default=0.0, help='Probability that an AWS call is throttled')
+@click.option('--page_size', type=click.INT, help='Page size of the AWS list calls')
+@click.option('--no_memory', is_flag=True, default=False, help='Do not trace memory, which slows every phase down')
+@click.option('--render_processes', type=click.IntRange(0, 64), default=0,
+              help='Render the model policies on this many processes, in the loadModelPolicies phase')
+def main(scales, output, work_dir, regenerate, workers, latency, throttle, page_size, no_memory, render_processes):
+    settings = backendSettings(latency, throttle, page_size)
+    results = []
+    for scale in [int(scale) for scale in scales.split(',')]:
+        click.echo('Running scale %d...' % scale, err=True)
+        results.append(runInProcess(scale, work_dir, settings, workers, not no_memory, regenerate, render_processes))
+
+    report = {
+        'version': RESULTS_VERSION,
+        'generator': synthetic.GENERATOR_VERSION,
+        'created': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {
+            'workers': workers,
+            'latency': latency,
+            'throttle': throttle,
+            'pageSize': page_size,
+            'traceMemory': not no_memory,
+            'renderProcesses': render_processes,
+        },
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    printSummary(results)
+    click.echo('Results written to %s' % output, err=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+import os
+import copy
+import json
+from datetime import datetime
+from utils.context import CSMContext
+import utils.utils as utils
+from utils.cache import dumpValue
+
+'''
+Synthetic accounts for the benchmarks.
+
+generate writes a model and a matching recorded AWS account for a target
+number of roles.  The model follows the patterns of json/model-v2.json: one
+summon policy per service, a backup policy for every fifth service, and the
+default ec2, logstash and logs_backup policies shared by every role in an
+env.  The account is written as fixtures for the fixtures backend.
+
+The account does not match the model exactly, so that compare and reconcile
+have work to do:
+
+  - every tenth policy has drifted, and already has five versions
+  - every twenty-fifth policy is missing
+  - every seventh role is missing its last policy
+  - every fiftieth role is missing
+  - one extra role per twenty model roles is not in the model
+'''
+
+GENERATOR_VERSION = 1
+
+REGION = 'us-west-2'
+ENVS = ['dev', 'test', 'qa', 'prod']
+DEFAULTS = ['ec2', 'logstash', 'logs_backup']
+ORG_ID = '123456789012'
+
+MODEL_TEMPLATE = '''{%% set regions = ['%(region)s'] %%}
+{%% set productEnvs = %(envs)s %%}
+{%% set services = %(services)s %%}
+{%% set defaults = %(defaults)s %%}
+{
+  "policies":{
+    {%% for region in regions %%}
+    "{{region}}": {
+      {%% for env in productEnvs %%}
+      "{{env}}":{
+        {%% for service in services %%}
+        "{{service}}": {
+            "{{region}}-{{env}}-{{service}}-summon":"summon.template"
+            {%%- if loop.index is divisibleby 5 -%%},
+            "{{region}}-{{env}}-{{service}}_backup":"mongo_backup.template"
+            {%%- endif %%}
+        },
+        {%% endfor %%}
+        "default": {
+          {%% for def in defaults %%}
+          "{{region}}-{{env}}-default-{{def}}":"default.{{def}}.template"{%%- if not loop.last -%%},{%%- endif %%}
+          {%% endfor %%}
+        }
+      }{%%- if not loop.last -%%},{%%- endif %%}
+      {%% endfor %%}
+    }{%%- if not loop.last -%%},{%%- endif %%}
+    {%% endfor %%}
+  },
+  "roles":{
+    {%% for region in regions %%}
+    "{{region}}": {
+      {%% for env in productEnvs %%}
+      "{{env}}":{
+        {%% for service in services %%}
+        "{{region}}-{{env}}-{{service}}": [
+          "{{region}}-{{env}}-{{service}}-summon",
+          {%%- if loop.index is divisibleby 5 %%}
+          "{{region}}-{{env}}-{{service}}_backup",
+          {%%- endif %%}
+          "{{region}}-{{env}}-default-ec2",
+          "{{region}}-{{env}}-default-logstash",
+          "{{region}}-{{env}}-default-logs_backup"
+        ]{%%- if not loop.last -%%},{%%- endif %%}
+        {%% endfor %%}
+      }{%%- if not loop.last -%%},{%%- endif %%}
+      {%% endfor %%}
+    }{%%- if not loop.last -%%},{%%- endif %%}
+    {%% endfor %%}
+  }
+}
+'''
+
+def scaleDir(workDir, scale):
+    return os.path.join(workDir, '%d-v%d' % (scale, GENERATOR_VERSION))
+
+def modelContext(modelDir, templateDir):
+    ctx = CSMContext()
+    ctx.region = REGION
+    ctx.orgId = ORG_ID
+    ctx.modelDir = modelDir
+    ctx.modelFile = 'model.json'
+    ctx.templateDir = templateDir
+    return ctx
+
+def writeModel(modelDir, scale):
+    services = ['svc%05d' % i for i in range(1, (scale + len(ENVS) - 1) // len(ENVS) + 1)]
+    os.makedirs(modelDir, exist_ok=True)
+    with open(os.path.join(modelDir, 'model.json'), 'w') as f:
+        f.write(MODEL_TEMPLATE % {
+            'region': REGION,
+            'envs': json.dumps(ENVS),
+            'services': json.dumps(services),
+            'defaults': json.dumps(DEFAULTS),
+        })
+
+def roleDetail(roleName, path, index, policyArns):
+    profile = {
+        'Path': '/',
+        'InstanceProfileName': roleName,
+        'InstanceProfileId': 'AIPASYNTH%011d' % index,
+        'Arn': 'arn:aws:iam::%s:instance-profile/%s' % (ORG_ID, roleName),
+        'CreateDate': '2020-01-01T00:00:00Z',
+        'Roles': [{
+            'Path': path,
+            'RoleName': roleName,
+            'RoleId': 'AROASYNTH%011d' % index,
+            'Arn': 'arn:aws:iam::%s:role%s%s' % (ORG_ID, path, roleName),
+            'CreateDate': '2020-01-01T00:00:00Z',
+        }],
+    }
+    detail = dict(profile['Roles'][0])
+    detail['AssumeRolePolicyDocument'] = {
+        'Version': '2012-10-17',
+        'Statement': [{'Action': 'sts:AssumeRole', 'Principal': {'Service': 'ec2.amazonaws.com'}, 'Effect': 'Allow', 'Sid': ''}]
+    }
+    detail['AttachedManagedPolicies'] = [
+        {'PolicyName': policyArn.split('/')[-1], 'PolicyArn': policyArn} for policyArn in policyArns]
+    detail['InstanceProfileList'] = [profile]
+    detail['RolePolicyList'] = []
+    return detail
+
+def policyDetail(policyName, index, document):
+    policyArn = 'arn:aws:iam::%s:policy/%s' % (ORG_ID, policyName)
+    # A plain copy, since model documents are frozen and the drift changes it
+    document = json.loads(json.dumps(document))
+    versions = [document]
+    if index % 10 == 3:
+        drifted = copy.deepcopy(document)
+        drifted['Statement'][0]['Sid'] = 'Drifted'
+        versions = [copy.deepcopy(drifted) for i in range(4)] + [drifted]
+    versionList = []
+    for number, versionDoc in enumerate(versions, 1):
+        versionList.append({
+            'VersionId': 'v%d' % number,
+            'IsDefaultVersion': number == len(versions),
+            'CreateDate': '2020-01-01T00:00:00Z',
+            'Document': versionDoc,
+        })
+    return {
+        'PolicyName': policyName,
+        'PolicyId': 'ANPASYNTH%011d' % index,
+        'Arn': policyArn,
+        'Path': '/',
+        'DefaultVersionId': 'v%d' % len(versions),
+        'AttachmentCount': 0,
+        'IsAttachable': True,
+        'CreateDate': '2020-01-01T00:00:00Z',
+        'UpdateDate': '2020-01-01T00:00:00Z',
+        'PolicyVersionList': versionList,
+    }
+
+def instance(index, roleName, profile):
+    return {
+        'InstanceId': 'i-%017x' % index,
+        'State': {'Name': 'running'},
+        'Tags': [{'Key': 'FullName', 'Value': roleName}],
+        'IamInstanceProfile': {'Id': profile['InstanceProfileId'], 'Arn': profile['Arn']},
+    }
+
+def writeFixtures(fixturesDir, ctx):
+    policies = []
+    present = set()
+    for index, policyName in enumerate(ctx.modelPolicies):
+        if index % 25 == 11:
+            continue
+        policies.append(policyDetail(policyName, index, ctx.modelPolicies[policyName]))
+        present.add(policyName)
+
+    roles = []
+    instances = []
+    index = 0
+    for region in ctx.model['roles']:
+        for env in ctx.model['roles'][region]:
+            for roleName, policyList in ctx.model['roles'][region][env].items():
+                index += 1
+                if index % 50 == 13:
+                    continue
+                attached = [policyName for policyName in policyList if policyName in present]
+                if index % 7 == 2:
+                    attached = attached[:-1]
+                path = '/%s/%s/%s/' % (region, env, roleName[len('%s-%s-' % (region, env)):])
+                arns = ['arn:aws:iam::%s:policy/%s' % (ORG_ID, policyName) for policyName in attached]
+                detail = roleDetail(roleName, path, index, arns)
+                roles.append(detail)
+                instances.append(instance(index, roleName, detail['InstanceProfileList'][0]))
+
+    extra = max(1, index // 20)
+    for number in range(extra):
+        index += 1
+        env = ENVS[number % len(ENVS)]
+        roleName = '%s-%s-retired%05d' % (REGION, env, number)
+        arns = ['arn:aws:iam::%s:policy/%s-%s-default-ec2' % (ORG_ID, REGION, env)]
+        roles.append(roleDetail(roleName, '/%s/%s/retired%05d/' % (REGION, env, number), index, arns))
+
+    os.makedirs(fixturesDir, exist_ok=True)
+    with open(os.path.join(fixturesDir, 'get_account_authorization_details.json'), 'w') as f:
+        f.write(dumpValue({'RoleDetailList': roles, 'Policies': policies}))
+    with open(os.path.join(fixturesDir, 'describe_instances.json'), 'w') as f:
+        f.write(dumpValue({'Reservations': [{'ReservationId': 'r-synthetic', 'Instances': instances}]}))
+    return len(roles), len(policies)
+
+def generate(workDir, scale, templateDir, regenerate=False):
+    '''
+    Writes the model and fixtures for a scale under workDir, unless they are
+    already there.  Returns (modelDir, fixturesDir).
+    '''
+    baseDir = scaleDir(workDir, scale)
+    modelDir = os.path.join(baseDir, 'model')
+    fixturesDir = os.path.join(baseDir, 'fixtures')
+    doneFile = os.path.join(baseDir, 'generated.json')
+    if os.path.exists(doneFile) and not regenerate:
+        return modelDir, fixturesDir
+
+    writeModel(modelDir, scale)
+    ctx = modelContext(modelDir, templateDir)
+    ctx.templates = utils.loadPolicyTemplates(ctx)
+    ctx.model = utils.loadModel(ctx)
+    ctx.modelPolicies = utils.loadModelPolicies(ctx)
+    roleCount, policyCount = writeFixtures(fixturesDir, ctx)
+    with open(doneFile, 'w') as f:
+        json.dump({
+            'scale': scale,
+            'generator': GENERATOR_VERSION,
+            'created': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'awsRoles': roleCount,
+            'awsPolicies': policyCount,
+        }, f)
+    return modelDir, fixturesDir
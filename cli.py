@@ -6,10 +6,16 @@ import csmutils.model as csm_model
 import csmutils.roles as csm_roles
 import csmutils.policies as csm_policies
 import csmutils.profiles as csm_profiles
+import csmutils.plan as csm_plan
+import csmutils.impact as csm_impact
+import csmutils.fanout as csm_fanout
 import awsutils.roles as aws_roles
 import awsutils.policies as aws_policies
+import awsutils.account as aws_account
 import utils.utils as utils
 from utils.context import CSMContext
+from utils.cache import StateCache, defaultCacheDir
+from awsutils import ratelimit
 
 pass_context = click.make_pass_decorator(CSMContext, ensure=True)
 
@@ -30,8 +36,27 @@ pass_context = click.make_pass_decorator(CSMContext, ensure=True)
 @click.option('--org_id', help='Org id for ARNs')
 @click.option('--dry_run', is_flag=True, default=False,
               help='Do not make actual changes to AWS')
+@click.option('--cache_dir', default=defaultCacheDir(),
+              help='Directory for the persistent IAM state cache')
+@click.option('--refresh', is_flag=True, default=False,
+              help='Ignore the cached IAM state and reload it from AWS')
+@click.option('--offline', is_flag=True, default=False,
+              help='Use only the cached IAM state.  Implies --dry_run')
+@click.option('--workers', type=click.IntRange(1, 64), default=8,
+              help='Number of concurrent AWS requests used when fetching')
+@click.option('--profile', is_flag=True, default=False,
+              help='Print a table of phase timings and AWS call counters on exit')
+@click.option('--profile_file', help='Write the phase timings and AWS call counters as JSON to this file')
+@click.option('--backend', default='aws',
+              help='aws, or fixtures:DIR[,latency=S,throttle=P,page_size=N,seed=N] to serve recorded responses from DIR')
+@click.option('--output', type=click.Choice(['text', 'jsonl']), default='text',
+              help='jsonl writes compare and audit results to stdout as one JSON record per line')
+@click.option('--rate_limits',
+              help='Starting AWS call rates per second, e.g. read=20,mutation=5.  Always on for the aws backend')
+@click.option('--render_processes', type=click.IntRange(0, 64), default=0,
+              help='Render every model policy up front on this many processes, for very large models')
 @pass_context
-def cli(ctx, mfa, verbose, pp, model_dir, model_file, templates_folder, org_id, dry_run):
+def cli(ctx, mfa, verbose, pp, model_dir, model_file, templates_folder, org_id, dry_run, cache_dir, refresh, offline, workers, profile, profile_file, backend, output, rate_limits, render_processes):
     if 'AWS_REGION' in os.environ:
         ctx.region = os.environ['AWS_REGION']
     elif 'AWS_DEFAULT_REGION' in os.environ:
@@ -54,12 +79,53 @@ def cli(ctx, mfa, verbose, pp, model_dir, model_file, templates_folder, org_id,
 
     ctx.verbose = verbose
     ctx.prettyprint = pp
+    ctx.output = output
     ctx.dry_run = dry_run
     ctx.modelDir = model_dir
     ctx.modelFile = model_file
     ctx.templateDir = templates_folder
+    ctx.workers = workers
+    ctx.renderProcesses = render_processes
 
-    if mfa:
+    if refresh and offline:
+        ctx.log('Error: --refresh and --offline cannot be used together', color='red')
+        sys.exit(1)
+    ctx.cacheDir = cache_dir
+    ctx.cache = StateCache(cache_dir)
+    ctx.refresh = refresh
+    ctx.offline = offline
+    if offline:
+        ctx.dry_run = True
+
+    click.get_current_context().call_on_close(ctx.cache.commit)
+    click.get_current_context().call_on_close(
+        lambda: utils.logTemplateStats(ctx, 'cli', templates_folder))
+    if profile:
+        click.get_current_context().call_on_close(ctx.instrumentation.printTable)
+    if profile_file != None:
+        click.get_current_context().call_on_close(
+            lambda: ctx.instrumentation.writeJson(profile_file))
+
+    if rate_limits != None or backend == 'aws':
+        try:
+            ctx.setRateLimits(ratelimit.parseRates(rate_limits or ''))
+        except ValueError as err:
+            ctx.log('Error: %s' % err, color='red')
+            sys.exit(1)
+        click.get_current_context().call_on_close(
+            lambda: ctx.vlog('cli: %.3fs spent waiting for the rate limits' % ctx.rateLimiter.waitSeconds()))
+
+    ctx.backendSpec = backend
+    if backend != 'aws':
+        if mfa:
+            ctx.log('Error: --mfa cannot be used with the %s backend' % backend, color='red')
+            sys.exit(1)
+        try:
+            ctx.setFixtureClients(backend)
+        except ValueError as err:
+            ctx.log('Error: %s' % err, color='red')
+            sys.exit(1)
+    elif mfa:
         ctx.getTempCredentials()
     else:
         ctx.setDefaultClients()
@@ -73,8 +139,6 @@ def roles(ctx):
     ctx.templates = utils.loadPolicyTemplates(ctx)
     ctx.model = utils.loadModel(ctx)
     ctx.modelPolicies = utils.loadModelPolicies(ctx)
-    csm_policies.getAWSPolicies(ctx)
-    csm_roles.getAWSRoles(ctx)
 
 @roles.command('audit', short_help='Audit AWS roles and policies')
 @click.option('-r','--region', help='Audit only this region')
@@ -85,6 +149,7 @@ def roles(ctx):
 @click.option('--context_lines', type=click.INT, help='Number of diff context lines to use.', default=0)
 @pass_context
 def roles_audit(ctx,region, env, role, no_diff, diff_type, context_lines):
+    aws_account.loadRoles(ctx, role)
     csm_roles.auditRoles(ctx, region, env, role, no_diff, diff_type, context_lines)
 
 @roles.command('compare', short_help='Compare AWS roles to model')
@@ -93,6 +158,7 @@ def roles_audit(ctx,region, env, role, no_diff, diff_type, context_lines):
 @click.option('--role', help='Compare only this role in region-env-role format')
 @pass_context
 def roles_compare(ctx,region, env, role):
+    aws_account.loadRoles(ctx, role)
     csm_roles.compareRoles(ctx, region, env, role)
 
 @roles.command('update', short_help='Update AWS roles from model')
@@ -102,6 +168,7 @@ def roles_compare(ctx,region, env, role):
 @click.option('--constrain', is_flag=True, default=False,help='Constrain policies to the model')
 @pass_context
 def roles_update(ctx,region, env, role, constrain):
+    aws_account.loadRoles(ctx, role)
     csm_roles.updateRoles(ctx, region, env, role, constrain)
 
 @roles.command('show', short_help='Show AWS roles')
@@ -110,12 +177,14 @@ def roles_update(ctx,region, env, role, constrain):
 @click.option('--role', help='Show only for this role in region-env-role format')
 @pass_context
 def roles_show_aws(ctx,region, env, role):
+    aws_account.loadRoles(ctx, role)
     csm_roles.showRoles(ctx, region, env, role)
 
 @roles.command('delete', short_help='Deleta an AWS role')
 @click.option('--role', help='Role in region-env-role format')
 @pass_context
 def roles_delete_aws(ctx, role):
+    aws_account.loadRoles(ctx, role)
     csm_roles.deleteRole(ctx, role)
 
 ########################################################################
@@ -127,19 +196,19 @@ def profiles(ctx):
     ctx.templates = utils.loadPolicyTemplates(ctx)
     ctx.model = utils.loadModel(ctx)
     ctx.modelPolicies = utils.loadModelPolicies(ctx)
-    csm_policies.getAWSPolicies(ctx)
-    csm_roles.getAWSRoles(ctx)
 
 
 @profiles.command('show', short_help='Show AWS Instance Profiles')
 @click.option('-r','--region', help='Show only for this region')
 @click.option('-e','--env', help='Show only for this env')
+@click.option('--role', help='Show only for this role')
 @click.option('--profilename', help='Show only for this profile name')
 @click.option('--id', help='Show only for this profile id')
 @click.option('--instances', is_flag=True, help='Show associated instances', default=False)
 @pass_context
-def profiles_show(ctx, region, env, profilename, id, instances):
-    csm_profiles.showInstanceProfiles(ctx, region, env, profilename, id, instances)
+def profiles_show(ctx, region, env, role, profilename, id, instances):
+    aws_account.loadProfiles(ctx)
+    csm_profiles.showInstanceProfiles(ctx, region, env, role, profilename, id, instances)
 
 
 ########################################################################
@@ -151,14 +220,13 @@ def policies(ctx):
     ctx.templates = utils.loadPolicyTemplates(ctx)
     ctx.model = utils.loadModel(ctx)
     ctx.modelPolicies = utils.loadModelPolicies(ctx)
-    csm_policies.getAWSPolicies(ctx)
-    csm_roles.getAWSRoles(ctx)
 
 
 @policies.command('delete', short_help='Compare model and AWS')
 @click.option('-p','--policy', help='Create only this Policy')
 @pass_context
 def policies_delete(ctx, policy):
+    aws_account.loadPolicies(ctx, policy)
     aws_policies.deletePolicy(ctx, policy)
 
 
@@ -169,6 +237,7 @@ def policies_delete(ctx, policy):
 @click.option('-p','--policy', help='Create only this Policy')
 @pass_context
 def policies_create(ctx, region, env, service, policy):
+    aws_account.loadPolicies(ctx, policy)
     csm_policies.createPolicy(ctx,region,env,service,policy)
 
 @policies.command('compare', short_help='Compare model and AWS')
@@ -179,8 +248,12 @@ def policies_create(ctx, region, env, service, policy):
 @click.option('--no_diff', is_flag=True, help='Do not show diff output', default=False)
 @click.option('--diff_type', type=click.Choice(['context','ndiff','unified']), help='Use context style diff output', default='unified')
 @click.option('--context_lines', type=click.INT, help='Number of diff context lines to use.', default=0)
+@click.option('--changed_since', help='Compare only the policies affected by template changes since this git revision')
 @pass_context
-def policies_compare(ctx, region, env, service, policy, no_diff, diff_type, context_lines):
+def policies_compare(ctx, region, env, service, policy, no_diff, diff_type, context_lines, changed_since):
+    if changed_since != None:
+        csm_impact.limitToChanges(ctx, changed_since)
+    aws_account.loadPolicies(ctx, policy)
     csm_policies.compareAllPolicies(ctx, region, env, service, policy, no_diff, diff_type, context_lines)
 
 @policies.command('update', short_help='Compare model and AWS')
@@ -190,9 +263,15 @@ def policies_compare(ctx, region, env, service, policy, no_diff, diff_type, cont
 @click.option('-p','--policy', help='Show only for this policy')
 @click.option('--constrain', is_flag=True, default=False,help='Constrain policies to the model')
 @click.option('--force', is_flag=True, default=False,help='Force a document upgrade, even if it matches')
+@click.option('--changed_since', help='Update only the policies affected by template changes since this git revision')
+@click.option('--keep_versions', type=click.IntRange(2, 5), default=5,
+              help='Prune the oldest versions so that this many remain after an update')
 @pass_context
-def policies_update(ctx, region, env, service, policy, constrain, force):
-    csm_policies.updatePolicies(ctx, region, env, service, policy, constrain, force)
+def policies_update(ctx, region, env, service, policy, constrain, force, changed_since, keep_versions):
+    if changed_since != None:
+        csm_impact.limitToChanges(ctx, changed_since)
+    aws_account.loadPolicies(ctx, policy)
+    csm_policies.updatePolicies(ctx, region, env, service, policy, constrain, force, keep_versions)
 
 @policies.command('show', short_help='Show the current AWS policy(s)')
 @click.option('-r','--region', help='Create only for this region')
@@ -201,6 +280,7 @@ def policies_update(ctx, region, env, service, policy, constrain, force):
 @click.option('-p','--policy', help='Show only for this policy')
 @pass_context
 def policies_show_aws_policy(ctx, region, env, service, policy):
+    aws_account.loadPolicies(ctx, policy)
     csm_policies.showAWSPolicy(ctx, region, env, service, policy)
 
 @policies.command('show_unattached', short_help='Show all unattached policies not in the model')
@@ -208,9 +288,66 @@ def policies_show_aws_policy(ctx, region, env, service, policy):
 def policies_show_model_policy(ctx):
     notInModel = True
     unattached = True
+    aws_account.loadPolicies(ctx)
     csm_policies.showAWS(ctx, notInModel, unattached)
 
 
+########################################################################
+##                       Plan and Apply
+########################################################################
+@cli.command('plan', short_help='Write the changes needed to match the model to a plan file')
+@click.option('-r','--region', help='Plan only for this region')
+@click.option('-e','--env', help='Plan only for this env')
+@click.option('--role', help='Plan only for this role in region-env-role format')
+@click.option('-s','--service', help='Plan only the policies for this service')
+@click.option('-p','--policy', help='Plan only this policy')
+@click.option('--constrain', is_flag=True, default=False,help='Constrain policies and roles to the model')
+@click.option('--force', is_flag=True, default=False,help='Force a document upgrade, even if it matches')
+@click.option('--plan_file', default='plan.json', help='File to write the plan to')
+@click.option('--changed_since', help='Plan only for the policies and roles affected by template changes since this git revision')
+@click.option('--keep_versions', type=click.IntRange(2, 5), default=5,
+              help='Prune the oldest versions so that this many remain after an update')
+@pass_context
+def plan(ctx, region, env, role, service, policy, constrain, force, plan_file, changed_since, keep_versions):
+    ctx.templates = utils.loadPolicyTemplates(ctx)
+    ctx.model = utils.loadModel(ctx)
+    ctx.modelPolicies = utils.loadModelPolicies(ctx)
+    if changed_since != None:
+        csm_impact.limitToChanges(ctx, changed_since)
+    if role == None:
+        aws_account.loadPolicies(ctx, policy)
+    if service == None and policy == None:
+        aws_account.loadRoles(ctx, role)
+    changePlan = csm_plan.buildPlan(ctx, region, env, role, service, policy, constrain, force, keep_versions)
+    csm_plan.writePlan(ctx, changePlan, plan_file)
+
+@cli.command('apply', short_help='Apply a plan file written by the plan command')
+@click.option('--plan_file', default='plan.json', help='Plan file to apply')
+@pass_context
+def apply(ctx, plan_file):
+    changePlan = csm_plan.readPlan(ctx, plan_file)
+    csm_plan.applyPlan(ctx, changePlan)
+
+########################################################################
+##                       Fan-out
+########################################################################
+@cli.command('fanout', short_help='Run audit, compare or update across accounts and regions')
+@click.argument('command', type=click.Choice(csm_fanout.COMMANDS))
+@click.option('--accounts', required=True, help='Comma separated ARNs of the role to assume in each account')
+@click.option('--regions', required=True, help='Comma separated regions')
+@click.option('-e','--env', help='Run only for this env')
+@click.option('--constrain', is_flag=True, default=False, help='Constrain policies and roles to the model (update)')
+@click.option('--no_diff', is_flag=True, default=False, help='Do not include diffs in the report (audit, compare)')
+@click.option('--parallel', type=click.IntRange(1, 64), default=4, help='Number of targets to run at once')
+@click.option('--report', default='fanout-report.json', help='File to write the merged JSON report to')
+@pass_context
+def fanout(ctx, command, accounts, regions, env, constrain, no_diff, parallel, report):
+    roleArns = [arn.strip() for arn in accounts.split(',') if arn.strip() != '']
+    regionList = [region.strip() for region in regions.split(',') if region.strip() != '']
+    merged = csm_fanout.runFanOut(ctx, command, roleArns, regionList, env, constrain, no_diff, parallel)
+    if csm_fanout.writeReport(ctx, merged, report) > 0:
+        sys.exit(1)
+
 ########################################################################
 ##                       Model Commands
 ########################################################################
@@ -233,6 +370,16 @@ def model(ctx):
 def model_show(ctx, region, env, role, service, policy):
     csm_model.showModel(ctx, region, env, role, service, policy)
 
+@model.command('impact', short_help='Show the policies and roles affected by template changes')
+@click.option('-t','--template', multiple=True, help='Changed template or snippet, e.g. snippets/s3_deployer.snippet')
+@click.option('--changed_since', help='Also take the templates changed since this git revision')
+@pass_context
+def model_impact(ctx, template, changed_since):
+    if len(template) == 0 and changed_since == None:
+        ctx.log('Error: give a --template or --changed_since', color='red')
+        sys.exit(1)
+    csm_impact.showImpact(ctx, template, changed_since)
+
 @model.command('json', short_help='Show the instantiated model object')
 @pass_context
 def model_json(ctx):
@@ -0,0 +1,190 @@
+import sys
+import json
+import time
+import threading
+import traceback
+from collections import OrderedDict, Counter
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import utils.utils as utils
+import awsutils.account as aws_account
+import csmutils.policies as csm_policies
+import csmutils.roles as csm_roles
+from awsutils.ratelimit import RateLimiter
+from utils.context import CSMContext
+
+'''
+Runs audit, compare or update against several accounts and regions at once.
+
+Every target, an account and a region, gets its own CSMContext, with its own
+clients made from the assumed role of the account, its own rendering of the
+model for the account and region, and its own account state.  Only the state
+cache, and the rate limiter of an account, are shared between targets, since
+IAM throttles per account rather than per region.  The targets run on a pool
+of threads; their log lines are prefixed with the target, and their compare
+and audit results are collected as --output jsonl records and merged into
+one report.
+'''
+
+REPORT_VERSION = 1
+COMMANDS = ['audit', 'compare', 'update']
+SESSION_NAME = 'iam-policy-manager'
+
+def accountOfRoleArn(roleArn):
+    # arn:aws:iam::123456789012:role/name
+    parts = roleArn.split(':')
+    if len(parts) < 6 or parts[2] != 'iam' or not parts[5].startswith('role/'):
+        raise ValueError('%s is not the ARN of an IAM role' % roleArn)
+    return parts[4]
+
+
+class TargetContext(CSMContext):
+    ''' The context of one target, which keeps its records instead of printing them '''
+    def __init__(self, parent, roleArn, region):
+        CSMContext.__init__(self)
+        self.roleArn = roleArn
+        self.orgId = accountOfRoleArn(roleArn)
+        self.region = region
+        self.verbose = parent.verbose
+        self.dry_run = parent.dry_run
+        self.modelDir = parent.modelDir
+        self.modelFile = parent.modelFile
+        self.templateDir = parent.templateDir
+        self.cacheDir = parent.cacheDir
+        self.cache = parent.cache
+        self.refresh = parent.refresh
+        self.offline = parent.offline
+        self.workers = parent.workers
+        self.backendSpec = parent.backendSpec
+        self.output = 'jsonl'
+        self.records = []
+
+    def name(self):
+        return '%s/%s' % (self.orgId, self.region)
+
+    def log(self, text, nl=True, err=False, color=None, **styles):
+        CSMContext.log(self, '[%s] %s' % (self.name(), text), nl=nl, err=err, color=color, **styles)
+
+    def emit(self, record):
+        record = OrderedDict(record)
+        record['account'] = self.orgId
+        record['region'] = self.region
+        with self.lock:
+            self.records.append(record)
+
+
+class FanOut(object):
+    def __init__(self, parent, command, roleArns, regions):
+        self.parent = parent
+        self.command = command
+        self.targets = [(roleArn, region) for roleArn in roleArns for region in regions]
+        self.lock = threading.Lock()
+        self.rateLimiters = {}
+
+    def rateLimiter(self, orgId):
+        with self.lock:
+            if orgId not in self.rateLimiters:
+                self.rateLimiters[orgId] = RateLimiter(self.parent.rateLimiter.rates)
+            return self.rateLimiters[orgId]
+
+    def connect(self, ctx):
+        if self.parent.rateLimiter != None:
+            ctx.rateLimiter = self.rateLimiter(ctx.orgId)
+            ctx.instrumentation.rateLimiter = ctx.rateLimiter
+        if ctx.backendSpec == 'aws':
+            ctx.setAssumedRoleClients(ctx.roleArn, SESSION_NAME)
+        else:
+            ctx.setFixtureClients(ctx.backendSpec)
+
+    def runCommand(self, ctx, env, constrain, no_diff):
+        ctx.templates = utils.loadPolicyTemplates(ctx)
+        ctx.model = utils.loadModel(ctx)
+        ctx.modelPolicies = utils.loadModelPolicies(ctx)
+        region = ctx.region
+        if self.command == 'audit':
+            aws_account.loadRoles(ctx)
+            csm_roles.auditRoles(ctx, region, env, None, no_diff, 'unified', 0)
+        elif self.command == 'compare':
+            aws_account.loadPolicies(ctx)
+            aws_account.loadRoles(ctx)
+            csm_policies.compareAllPolicies(ctx, region, env, None, None, no_diff, 'unified', 0)
+            csm_roles.compareRoles(ctx, region, env, None)
+        else:
+            aws_account.loadPolicies(ctx)
+            aws_account.loadRoles(ctx)
+            csm_policies.updatePolicies(ctx, region, env, None, None, constrain, False)
+            csm_roles.updateRoles(ctx, region, env, None, constrain)
+
+    def runTarget(self, roleArn, region, env, constrain, no_diff):
+        ctx = TargetContext(self.parent, roleArn, region)
+        result = OrderedDict([('account', ctx.orgId), ('region', region), ('roleArn', roleArn)])
+        start = time.perf_counter()
+        try:
+            self.connect(ctx)
+            self.runCommand(ctx, env, constrain, no_diff)
+            result['status'] = 'ok'
+        except SystemExit:
+            # The error has already been logged
+            result['status'] = 'error'
+            result['error'] = 'exited'
+        except Exception as err:
+            ctx.log('Error: %s' % err, color='red')
+            ctx.vlog(traceback.format_exc())
+            result['status'] = 'error'
+            result['error'] = str(err)
+        result['seconds'] = round(time.perf_counter() - start, 6)
+        operations = ctx.instrumentation.report()['operations']
+        result['calls'] = sum(stats['calls'] for stats in operations.values())
+        result['summary'] = summarize(ctx.records)
+        result['records'] = ctx.records
+        return result
+
+    def run(self, env, constrain, no_diff, parallel):
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            futures = []
+            for roleArn, region in self.targets:
+                futures.append(pool.submit(self.runTarget, roleArn, region, env, constrain, no_diff))
+            results = [future.result() for future in futures]
+        report = OrderedDict()
+        report['version'] = REPORT_VERSION
+        report['command'] = self.command
+        report['created'] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        report['dryRun'] = self.parent.dry_run
+        report['targets'] = results
+        report['rateLimits'] = OrderedDict(
+            (orgId, limiter.report()) for orgId, limiter in sorted(self.rateLimiters.items()))
+        return report
+
+def summarize(records):
+    ''' Counts of the records by type and status, e.g. {'policy.different': 3} '''
+    counts = Counter()
+    for record in records:
+        if 'status' in record:
+            counts['%s.%s' % (record['type'], record['status'])] += 1
+    return OrderedDict(sorted(counts.items()))
+
+def runFanOut(ctx, command, roleArns, regions, env, constrain, no_diff, parallel):
+    for roleArn in roleArns:
+        try:
+            accountOfRoleArn(roleArn)
+        except ValueError as err:
+            ctx.log('Error: %s' % err, color='red')
+            sys.exit(1)
+    fanOut = FanOut(ctx, command, roleArns, regions)
+    ctx.log('Running %s for %d targets, %d at a time' % (command, len(fanOut.targets), parallel))
+    return fanOut.run(env, constrain, no_diff, parallel)
+
+def writeReport(ctx, report, reportFile):
+    with open(reportFile, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+    failed = 0
+    for result in report['targets']:
+        if result['status'] != 'ok':
+            failed += 1
+        summary = ', '.join('%s=%d' % item for item in result['summary'].items())
+        ctx.log('%-30s %-6s %8.3fs %6d calls  %s' % ('%s/%s' % (result['account'], result['region']),
+            result['status'], result['seconds'], result['calls'], summary),
+            fg='red' if result['status'] != 'ok' else None)
+    ctx.log('Report for %d targets, %d failed, written to %s' % (len(report['targets']), failed, reportFile))
+    return failed
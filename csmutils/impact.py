@@ -0,0 +1,132 @@
+import sys
+import subprocess
+import click
+import utils.utils as utils
+
+'''
+Dependencies from templates to the model policies and roles rendered from
+them.
+
+A template depends on the templates it includes, imports or extends, as
+found in the Jinja nodes of its source, so an edit to a snippet reaches every
+template that includes it.  A model policy depends on the template the model
+names for it, and a model role on the policies it attaches.
+
+limitToChanges narrows compare, update and plan to the policies and roles
+affected by the template edits made since a git revision.
+'''
+
+def templateDependents(env):
+    ''' Map of template path to the templates that reference it directly '''
+    dependents = {}
+    for name in env.list_templates():
+        for reference in env.references(name):
+            dependents.setdefault(reference, set()).add(name)
+    return dependents
+
+def affectedTemplates(env, changed):
+    ''' The changed templates and every template that depends on them '''
+    dependents = templateDependents(env)
+    affected = set()
+    pending = list(changed)
+    while len(pending) > 0:
+        name = pending.pop()
+        if name in affected:
+            continue
+        affected.add(name)
+        pending.extend(dependents.get(name, []))
+    return affected
+
+def affectedPolicies(ctx, templates):
+    policies = []
+    for policyName, (templateName, props) in ctx.modelPolicies.index.items():
+        if utils.templatePath(templateName) in templates:
+            policies.append(policyName)
+    return policies
+
+def affectedRoles(ctx, policies):
+    policies = set(policies)
+    roles = []
+    ctxRoles = ctx.model['roles']
+    for region in ctxRoles:
+        for env in ctxRoles[region]:
+            for roleName, policyList in ctxRoles[region][env].items():
+                if not policies.isdisjoint(policyList):
+                    roles.append(roleName)
+    return roles
+
+def resolveTemplate(ctx, env, name):
+    ''' Template path for a path, a model template name, or a unique file name '''
+    names = env.list_templates()
+    if name in names:
+        return name
+    if utils.templatePath(name) in names:
+        return utils.templatePath(name)
+    matches = [path for path in names if path.split('/')[-1] == name]
+    if len(matches) == 1:
+        return matches[0]
+    ctx.log('Error: %s is not a template in %s' % (name, ctx.templateDir), color='red')
+    sys.exit(1)
+
+def gitChanges(ctx, folder, gitRev):
+    ''' Files under folder, relative to it, changed or added since gitRev '''
+    commands = [
+        ['git', '-C', folder, 'diff', '--name-only', '--relative', gitRev, '--', '.'],
+        ['git', '-C', folder, 'ls-files', '--others', '--exclude-standard', '--', '.'],
+    ]
+    changed = set()
+    for command in commands:
+        try:
+            output = subprocess.check_output(command, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as err:
+            stderr = getattr(err, 'stderr', None) or b''
+            ctx.log('Error: cannot list the changes to %s since %s: %s' % (
+                folder, gitRev, stderr.decode('utf-8', 'replace').strip() or err), color='red')
+            sys.exit(1)
+        changed.update(line for line in output.decode('utf-8').splitlines() if line != '')
+    return changed
+
+def changedTemplates(ctx, gitRev):
+    '''
+    The template paths changed since gitRev, and whether the model changed.
+    A changed model may map any policy to any template.
+    '''
+    modelEnv = utils.getTemplateEnvironment(ctx, ctx.modelDir)
+    modelChanges = gitChanges(ctx, ctx.modelDir, gitRev)
+    modelChanged = ctx.modelFile in affectedTemplates(modelEnv, modelChanges)
+    return gitChanges(ctx, ctx.templateDir, gitRev), modelChanged
+
+def limitToChanges(ctx, gitRev):
+    templates, modelChanged = changedTemplates(ctx, gitRev)
+    if modelChanged:
+        ctx.log('%s changed since %s, so every policy is affected' % (ctx.modelFile, gitRev))
+        return
+    env = utils.getTemplateEnvironment(ctx, ctx.templateDir)
+    policies = affectedPolicies(ctx, affectedTemplates(env, templates))
+    roles = affectedRoles(ctx, policies)
+    ctx.impactPolicies = set(policies)
+    ctx.impactRoles = set(roles)
+    ctx.log('%d templates changed since %s: %d policies and %d roles affected' % (
+        len(templates), gitRev, len(policies), len(roles)))
+
+def showImpact(ctx, templateNames, gitRev):
+    env = utils.getTemplateEnvironment(ctx, ctx.templateDir)
+    changed = set(resolveTemplate(ctx, env, name) for name in templateNames)
+    if gitRev != None:
+        templates, modelChanged = changedTemplates(ctx, gitRev)
+        if modelChanged:
+            ctx.log('%s changed since %s, so every policy is affected' % (ctx.modelFile, gitRev))
+        changed.update(templates)
+    templates = affectedTemplates(env, changed)
+    policies = affectedPolicies(ctx, templates)
+    roles = affectedRoles(ctx, policies)
+
+    ctx.log(click.style('Templates: %d' % len(templates), fg='cyan'))
+    for name in sorted(templates):
+        ctx.log('    %s' % name)
+    ctx.log(click.style('Policies: %d' % len(policies), fg='cyan'))
+    for policyName in policies:
+        ctx.log('    %s' % policyName)
+    ctx.log(click.style('Roles: %d' % len(roles), fg='cyan'))
+    for roleName in roles:
+        ctx.log('    %s' % roleName)
@@ -0,0 +1,156 @@
+import sys
+import json
+from datetime import datetime
+import awsutils.roles as aws_roles
+import awsutils.policies as aws_policies
+import awsutils.profiles as aws_profiles
+from awsutils.records import Role, InstanceProfile
+import csmutils.policies as csm_policies
+import csmutils.roles as csm_roles
+import csmutils.reconcile as csm_reconcile
+from csmutils.policies import PolicyChange
+from csmutils.reconcile import RoleChange
+import utils.cache as cache
+
+'''
+Change plans for the 'plan' and 'apply' commands.
+
+buildPlan works out every change that 'policies update' and 'roles update'
+would make and writePlan saves them as a compact JSON document.  Along with
+the changes, the plan records the AWS facts that applying them depends on:
+the ARN of every policy it touches, and the attached policies and instance
+profiles of every role it deletes.  applyPlan seeds the context with those
+facts, so a plan is applied without reloading the account or rendering the
+model again.
+'''
+
+PLAN_VERSION = 1
+
+def buildPlan(ctx, targetRegion, targetEnv, targetRole, targetService, targetPolicy, constrainToModel, force, keepVersions):
+    plan = {
+        'version': PLAN_VERSION,
+        'orgId': ctx.orgId,
+        'region': ctx.region,
+        'created': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'constrain': constrainToModel,
+        'policies': [],
+        'roles': [],
+        'deleteRoles': [],
+        'policyArns': {},
+    }
+    policyArns = plan['policyArns']
+
+    if targetRole == None:
+        targets = csm_policies.targetPolicies(ctx, targetRegion, targetEnv, targetService, targetPolicy)
+        for change in csm_policies.planPolicyChanges(ctx, targets, constrainToModel, force, keepVersions):
+            plan['policies'].append({
+                'policy': change.policyName,
+                'arn': change.policyArn,
+                'create': change.create,
+                'document': change.document,
+                'deleteVersions': change.deleteVersions,
+            })
+            policyArns[change.policyName] = change.policyArn
+
+    if targetService == None and targetPolicy == None:
+        targets = csm_roles.targetModelRoles(ctx, targetRegion, targetEnv, targetRole)
+        for change in csm_reconcile.planRoleChanges(ctx, targets, constrainToModel):
+            entry = {
+                'role': change.roleName,
+                'create': change.create,
+                'attach': change.attach,
+                'detach': change.detach,
+            }
+            if not change.create:
+                entry['path'] = ctx.getRole(change.roleName).path
+            plan['roles'].append(entry)
+            for policyName in change.attach + change.detach:
+                recordPolicyArn(ctx, policyArns, policyName)
+
+        # Roles outside the model are not affected by template changes
+        if constrainToModel and ctx.impactRoles == None:
+            for roleName in csm_roles.extraAWSRoles(ctx, targetRegion, targetEnv, targetRole):
+                ctx.log('Deleting role not in the model: %s' % roleName)
+                plan['deleteRoles'].append(planRoleDelete(ctx, roleName, policyArns))
+    return plan
+
+def recordPolicyArn(ctx, policyArns, policyName):
+    if policyName in policyArns:
+        return
+    meta = aws_policies.getPolicyMeta(ctx, policyName)
+    if meta != None:
+        policyArns[policyName] = meta.arn
+
+def planRoleDelete(ctx, roleName, policyArns):
+    attached = aws_roles.getAttachedPolicies(ctx, roleName)
+    for policyName in attached:
+        recordPolicyArn(ctx, policyArns, policyName)
+    profiles = []
+    instanceProfiles, _ = aws_profiles.getInstanceProfilesForRoleName(ctx, roleName)
+    for profile in instanceProfiles:
+        profiles.append({
+            'InstanceProfileName': profile.profileName,
+            'InstanceProfileId': profile.profileId,
+            'Arn': profile.arn,
+        })
+    return {
+        'role': roleName,
+        'path': ctx.getRole(roleName).path,
+        'attached': attached,
+        'instanceProfiles': profiles,
+    }
+
+def writePlan(ctx, plan, planFile):
+    with open(planFile, 'w') as f:
+        f.write(cache.dumpValue(plan))
+        f.write('\n')
+    ctx.log('Plan: %d policy changes, %d role changes, %d role deletes written to %s' % (
+        len(plan['policies']), len(plan['roles']), len(plan['deleteRoles']), planFile))
+
+def readPlan(ctx, planFile):
+    try:
+        with open(planFile) as f:
+            plan = json.load(f)
+    except (IOError, ValueError) as err:
+        ctx.log('Error: cannot read plan %s: %s' % (planFile, err), color='red')
+        sys.exit(1)
+    if plan.get('version') != PLAN_VERSION:
+        ctx.log('Error: %s is not a version %d plan' % (planFile, PLAN_VERSION), color='red')
+        sys.exit(1)
+    if plan['orgId'] != ctx.orgId:
+        ctx.log('Error: plan %s was made for account %s, not %s' % (planFile, plan['orgId'], ctx.orgId), color='red')
+        sys.exit(1)
+    return plan
+
+def seedContext(ctx, plan):
+    for policyName, policyArn in plan['policyArns'].items():
+        aws_policies.storePolicyMeta(ctx, {'PolicyName': policyName, 'Arn': policyArn})
+    for entry in plan['roles']:
+        if not entry['create']:
+            ctx.addRole(Role(entry['role'], entry['path']))
+    for entry in plan['deleteRoles']:
+        roleName = entry['role']
+        ctx.addRole(Role(roleName, entry['path']))
+        ctx.attachedPolicies[roleName] = list(entry['attached'])
+        for profile in entry['instanceProfiles']:
+            ctx.addInstanceProfile(InstanceProfile(profile['InstanceProfileName'],
+                profile['InstanceProfileId'], profile['Arn'], [roleName]))
+    ctx.snapshotLoaded = True
+
+def applyPlan(ctx, plan):
+    seedContext(ctx, plan)
+
+    policyChanges = []
+    for entry in plan['policies']:
+        policyChanges.append(PolicyChange(entry['policy'], entry['arn'], entry['create'],
+            entry['document'], entry['deleteVersions']))
+    csm_policies.applyPolicyChanges(ctx, policyChanges)
+
+    roleChanges = []
+    for entry in plan['roles']:
+        roleChanges.append(RoleChange(entry['role'], entry['create'], entry['attach'], entry['detach']))
+    csm_reconcile.applyRoleChanges(ctx, roleChanges)
+
+    with ctx.span('apply'):
+        for entry in plan['deleteRoles']:
+            aws_roles.deleteRole(ctx, entry['role'])
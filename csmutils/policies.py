@@ -7,7 +7,8 @@ import awsutils.instances as aws_instances
 import utils.utils as utils
 import click
 import difflib
-from utils.utils import Reorder
+import itertools
+from utils.instrument import spanned
 
 policyTemplates={}
 
@@ -35,55 +36,98 @@ def getModelPolicyDocument(ctx, policyName):
         policyDoc = ctx.modelPolicies[policyName]
         return policyDoc
 
-def compareModel2AWS(ctx, policyName, meta, diff_type, context_lines):
-
-    docModel = ['Version','Statement']
-    stmtModel = ['Effect','Action','Resource']
-    statement = Reorder()
-    statement.model = stmtModel
-    document = Reorder()
-    document.model = docModel
-
+def compareModel2AWS(ctx, policyName, meta, diff_type, context_lines, no_diff=False):
     ctx.vlog('Fetching AWS policy: %s' % policyName)
     awsPolicy = aws_policies.getDefaultPolicyVersion(ctx, policyName)
     if awsPolicy == None:
         return False, None
-    awsPolicy = document.do(awsPolicy)
-    awsPolicy['Statement'] = statement.dolist(awsPolicy['Statement'])
-    awsDoc = json.dumps(awsPolicy, indent=4)
 
     ctx.vlog('Fetching Model policy')
     modelPolicy = getModelPolicyDocument(ctx, policyName)
-    modelDoc = json.dumps(modelPolicy, indent=4)
-    matched = True
-    diff = None
+
+    key = comparisonKey(modelPolicy, awsPolicy)
+    if key not in ctx.comparisons:
+        # Equivalent documents hash the same, so only mismatches need a diff
+        ctx.comparisons[key] = utils.policyHash(modelPolicy) == utils.policyHash(awsPolicy)
+    if ctx.comparisons[key]:
+        return True, None
+    if no_diff:
+        return False, None
+
+    # The diff is of the canonical forms that were hashed, so that it shows
+    # every difference that made them mismatch, and none that did not
+    awsDoc = json.dumps(utils.canonicalPolicy(awsPolicy), indent=4, sort_keys=True)
+    modelDoc = json.dumps(utils.canonicalPolicy(modelPolicy), indent=4, sort_keys=True)
+    return False, diffPolicies(ctx, modelDoc, awsDoc, diff_type, context_lines)
+
+'''
+Whether a model and an AWS document match is memoized per pair, by their
+exact content hashes.  Many policies render the same model document, and
+AWS then holds the same version for each of them, so most pairs repeat.
+Diffs are not kept; each mismatch gets its own lazy diff.
+'''
+def comparisonKey(modelPolicy, awsPolicy):
+    modelHash = getattr(modelPolicy, 'contentHash', None)
+    if modelHash == None:
+        modelHash = utils.documentHash(modelPolicy)
+    return (modelHash, utils.documentHash(awsPolicy))
+
+'''
+The diff is an iterator of lines, or None when there is no difference.  Lines
+are produced as they are consumed; only the lines up to the first change are
+read ahead, to find out whether there is a difference at all.
+'''
+@spanned('diff')
+def diffPolicies(ctx, modelDoc, awsDoc, diff_type, context_lines):
     if diff_type == 'context':
-        d = difflib.context_diff(modelDoc.splitlines(),awsDoc.splitlines(), "AWS","Model", n=context_lines)
-        dd = list(d)
-        if len(dd) > 0:
-            matched = False
-            diff = dd
+        d = difflib.context_diff(awsDoc.splitlines(), modelDoc.splitlines(), "AWS","Model", n=context_lines)
+        isChange = lambda line: True
     elif diff_type == 'ndiff':
-        d = difflib.ndiff(modelDoc.splitlines(),awsDoc.splitlines())
-        dd = list(d)
-        for line in dd:
-            if line[0] == '-' or line[0] == '+'  or line[0] == '?':
-                matched = False
-                diff = dd
-
+        d = difflib.ndiff(awsDoc.splitlines(), modelDoc.splitlines())
+        isChange = lambda line: line[0] == '-' or line[0] == '+'  or line[0] == '?'
     else:
-        d = difflib.unified_diff(modelDoc.splitlines(),awsDoc.splitlines(), "AWS","Model", n=context_lines)
-        dd = list(d)
-        if len(dd) > 0:
-            matched = False
-            diff = dd
+        d = difflib.unified_diff(awsDoc.splitlines(), modelDoc.splitlines(), "AWS","Model", n=context_lines)
+        isChange = lambda line: True
 
-    return matched, diff
+    head = []
+    for line in d:
+        head.append(line)
+        if isChange(line):
+            return itertools.chain(head, d)
+    return None
+
+def isHunkStart(line, diff_type):
+    if diff_type == 'context':
+        return line.startswith('***************')
+    if diff_type == 'ndiff':
+        return line[0] in '-+?'
+    return line.startswith('@@')
+
+def diffHunks(diff, diff_type):
+    '''
+    Groups diff lines into hunks, one at a time.  The file headers are a hunk
+    of their own, and an ndiff hunk is one run of changed lines.
+    '''
+    hunk = []
+    for line in diff:
+        if diff_type == 'ndiff':
+            if isHunkStart(line, diff_type):
+                hunk.append(line)
+            elif len(hunk) > 0:
+                yield hunk
+                hunk = []
+            continue
+        if isHunkStart(line, diff_type) and len(hunk) > 0:
+            yield hunk
+            hunk = []
+        hunk.append(line)
+    if len(hunk) > 0:
+        yield hunk
 
 def isValidTarget(ctx,policyName, targetRegion, targetEnv, targetService, targetPolicy):
     if targetPolicy != None and policyName != targetPolicy:
         return False
-    region, env, service = utils.regionEnvAndRole(policyName)
+    region, env, service = ctx.modelPolicies.names.get(policyName)
     if targetRegion != None and region != targetRegion:
         return False
     if targetEnv != None and env != targetEnv:
@@ -92,13 +136,16 @@ def isValidTarget(ctx,policyName, targetRegion, targetEnv, targetService, target
         return False
     return True
 
-def comparePolicy(ctx, policyName, no_diff, diff_type, context_lines, offset):
+def comparePolicy(ctx, policyName, no_diff, diff_type, context_lines, offset, roleName=None):
+    if ctx.jsonl():
+        emitPolicyComparison(ctx, policyName, no_diff, diff_type, context_lines, roleName)
+        return
     ctx.log('%s%-43s' % (offset, policyName),nl=False)
     meta = aws_policies.getPolicyMeta(ctx, policyName)
     if meta == None:
             ctx.log(' not found at AWS!', fg='cyan')
             return
-    matched, diff = compareModel2AWS(ctx,policyName, meta, diff_type, context_lines)
+    matched, diff = compareModel2AWS(ctx,policyName, meta, diff_type, context_lines, no_diff)
     if matched:
         ctx.log(' MATCHED')
     else:
@@ -108,53 +155,125 @@ def comparePolicy(ctx, policyName, no_diff, diff_type, context_lines, offset):
             for line in diff:
                 ctx.log('%s   %s' % (offset, line), fg='cyan')
 
+def emitPolicyComparison(ctx, policyName, no_diff, diff_type, context_lines, roleName):
+    ''' The --output jsonl form of comparePolicy: a policy record, then one record per diff hunk '''
+    record = OrderedDict([('type', 'policy'), ('policy', policyName)])
+    if roleName != None:
+        record['role'] = roleName
+    meta = aws_policies.getPolicyMeta(ctx, policyName)
+    if meta == None:
+        record['status'] = 'missing'
+        ctx.emit(record)
+        return
+    matched, diff = compareModel2AWS(ctx,policyName, meta, diff_type, context_lines, no_diff)
+    record['status'] = 'matched' if matched else 'different'
+    ctx.emit(record)
+    if diff == None:
+        return
+    for hunk in diffHunks(diff, diff_type):
+        hunkRecord = OrderedDict([('type', 'diff'), ('policy', policyName)])
+        if roleName != None:
+            hunkRecord['role'] = roleName
+        hunkRecord['diffType'] = diff_type
+        hunkRecord['lines'] = [line.rstrip('\n') for line in hunk]
+        ctx.emit(hunkRecord)
 
-def compareAllPolicies(ctx, targetRegion, targetEnv, targetService, targetPolicy, no_diff, diff_type, context_lines):
 
-    for policyName in ctx.modelPolicies:
-        if isValidTarget(ctx,policyName, targetRegion, targetEnv, targetService, targetPolicy) == False:
-            continue
+def targetPolicies(ctx, targetRegion, targetEnv, targetService, targetPolicy):
+    ''' The model policies that pass the filters, in model order '''
+    selected = ctx.modelPolicies.names.select(targetRegion, targetEnv, targetService)
+    if targetPolicy != None:
+        selected = selected.intersection([targetPolicy])
+    if ctx.impactPolicies != None:
+        selected = selected.intersection(ctx.impactPolicies)
+    if len(selected) == len(ctx.modelPolicies):
+        return list(ctx.modelPolicies)
+    return [policyName for policyName in ctx.modelPolicies if policyName in selected]
+
+@spanned('compare')
+def compareAllPolicies(ctx, targetRegion, targetEnv, targetService, targetPolicy, no_diff, diff_type, context_lines):
+    targets = targetPolicies(ctx, targetRegion, targetEnv, targetService, targetPolicy)
+    aws_policies.prefetchPolicyDocuments(ctx, targets)
+    for policyName in targets:
         comparePolicy(ctx, policyName, no_diff, diff_type, context_lines,'')
 
-def updatePolicies(ctx, targetRegion, targetEnv, targetService, targetPolicy, constrainToModel, force):
-    for policyName in ctx.modelPolicies:
-        if isValidTarget(ctx,policyName, targetRegion, targetEnv, targetService, targetPolicy) == False:
-            continue
+'''
+A change to one model policy: either create it, or give it a new default
+version after deleting the listed old versions.
+'''
+class PolicyChange(object):
+    def __init__(self, policyName, policyArn, create, document, deleteVersions):
+        self.policyName = policyName
+        self.policyArn = policyArn
+        self.create = create
+        self.document = document
+        self.deleteVersions = deleteVersions
+
+@spanned('plan')
+def planPolicyChanges(ctx, targets, constrainToModel, force, keepVersions=aws_policies.MAX_VERSIONS):
+    changes = []
+    updates = []
+    if not force:
+        aws_policies.prefetchPolicyDocuments(ctx, targets)
+    for policyName in targets:
         meta = aws_policies.getPolicyMeta(ctx, policyName)
         if meta == None:
             ctx.log('Adding model policy not found in AWS: %s' % policyName)
-            createPolicy(ctx, None, None, None, policyName)
+            policyArn = aws_policies.guessIamArn(ctx, policyName)
+            changes.append(PolicyChange(policyName, policyArn, True,
+                getModelPolicyDocument(ctx, policyName), []))
             continue
 
         ctx.log('Model policy found in AWS: %s.  Comparing policy document' % policyName)
-        policyArn = meta['Arn']
+        policyArn = meta.arn
 
         if force:
             ctx.log('Forcing an update.  No compare necessary.')
         else:
-            matched, diff = compareModel2AWS(ctx,policyName, meta,'unified',0)
+            matched, diff = compareModel2AWS(ctx,policyName, meta,'unified',0, True)
             if matched:
                 ctx.log('%s: MATCHED.  Noting to update.' % policyName)
                 continue
 
         ctx.log('%s: DID NOT MATCH' % policyName)
         if force or constrainToModel:
-            # Need to update the policy.  Get the number of
-            versions = aws_policies.getPolicyVersions(ctx,meta['Arn'])
-            if len(versions) >= 5:
-                # Too many versions, gotta delete 1
-                versions.sort()
-                defaultVersionId = meta['DefaultVersionId']
-                for version in versions:
-                    if version != defaultVersionId:
-                        aws_policies.deletePolicyVersion(ctx,policyArn, version)
-                        break
-            modelPolicy = getModelPolicyDocument(ctx, policyName)
-            policyDocument = json.dumps(modelPolicy,indent=4)
-            aws_policies.createPolicyVersion(ctx, policyArn, policyDocument)
+            # The versions to prune are filled in below, once the version
+            # lists of all of the updated policies have been fetched
+            change = PolicyChange(policyName, policyArn, False,
+                getModelPolicyDocument(ctx, policyName), [])
+            changes.append(change)
+            updates.append((change, meta))
+
+    aws_policies.prefetchPolicyVersions(ctx, [meta.arn for change, meta in updates])
+    for change, meta in updates:
+        versions = aws_policies.getPolicyVersions(ctx, meta.arn)
+        change.deleteVersions = aws_policies.versionsToPrune(versions, meta.defaultVersionId, keepVersions)
+    return changes
+
+def applyPolicyChange(ctx, change):
+    policyDocument = json.dumps(change.document, indent=4)
+    if change.create:
+        ctx.log('Creating policy : %s' % change.policyName)
+        aws_policies.createPolicy(ctx, change.policyName, policyDocument)
+        return
+    for versionId in change.deleteVersions:
+        aws_policies.deletePolicyVersion(ctx, change.policyArn, versionId)
+    aws_policies.createPolicyVersion(ctx, change.policyArn, policyDocument)
+
+@spanned('apply')
+def applyPolicyChanges(ctx, changes):
+    # One at a time, in plan order, so that the first failure stops the rest
+    for change in changes:
+        applyPolicyChange(ctx, change)
+
+def updatePolicies(ctx, targetRegion, targetEnv, targetService, targetPolicy, constrainToModel, force, keepVersions=aws_policies.MAX_VERSIONS):
+    targets = targetPolicies(ctx, targetRegion, targetEnv, targetService, targetPolicy)
+    changes = planPolicyChanges(ctx, targets, constrainToModel, force, keepVersions)
+    applyPolicyChanges(ctx, changes)
 
 
 
+@spanned('apply')
 def createPolicy(ctx, targetRegion, targetEnv, targetService, targetPolicy):
     policies = ctx.modelPolicies
     ctx.vlog('createPolicy(targetRegion: %s targetEnv: %s targetService: %s targetPolicy: %s)' % (targetRegion, targetEnv, targetService, targetPolicy))
@@ -174,28 +293,32 @@ def createPolicy(ctx, targetRegion, targetEnv, targetService, targetPolicy):
         aws_policies.createPolicy(ctx, policyName, policyDocument)
 
 
+@spanned('show')
 def showAWSPolicy(ctx, targetRegion, targetEnv, targetService, targetPolicy):
 
     if targetPolicy != None:
+            aws_policies.prefetchPolicyDocuments(ctx, [targetPolicy])
             meta = ctx.awsPolicyMeta[targetPolicy]
-            click.echo('%s:  %s' % (targetPolicy, meta) )
+            click.echo('%s:  %s' % (targetPolicy, dict(meta.asDict())) )
             click.echo('')
             policyDocument = aws_policies.getDefaultPolicyVersion(ctx, targetPolicy)
             click.echo(ctx.dumps(policyDocument))
     else:
+        aws_policies.prefetchPolicyDocuments(ctx, list(ctx.awsPolicyMeta))
         for policyName in ctx.awsPolicyMeta:
             meta = ctx.awsPolicyMeta[policyName]
-            click.echo('%s:  %s' % (policyName, meta) )
+            click.echo('%s:  %s' % (policyName, dict(meta.asDict())) )
             click.echo('')
             policyDocument = aws_policies.getDefaultPolicyVersion(ctx, policyName)
             click.echo(ctx.dumps(policyDocument))
             click.echo('-------------------------------------')
             click.echo('')
 
+@spanned('show')
 def showAWS(ctx, notInModel, unattached):
     for policyName in ctx.awsPolicyMeta:
         meta = ctx.awsPolicyMeta[policyName]
-        attachments = meta['AttachmentCount']
+        attachments = meta.attachmentCount
         if unattached and attachments > 0:
             continue
         if notInModel and policyName in ctx.modelPolicies:
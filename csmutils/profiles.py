@@ -9,43 +9,60 @@ import utils.utils as utils
 import click
 import difflib
 from utils.utils import Reorder
+from utils.instrument import spanned
 
 
 
+def summarizeInstances(ctx, targetRegion, targetEnv):
+    # Keep only what gets printed for each instance, grouped by profile id
+    instancesByProfileId = {}
+    filters = aws_instances.instanceFilters(targetRegion, targetEnv)
+    for instance in aws_instances.iterFilteredInstances(ctx, filters):
+        fullName = aws_instances.getTag(ctx, instance.get('Tags'), 'FullName')
+        state = instance['State']['Name']
+        profileId = aws_instances.profileIdOf(instance)
+        if profileId not in instancesByProfileId:
+            instancesByProfileId[profileId] = []
+        instancesByProfileId[profileId].append((fullName, state))
+    return instancesByProfileId
+
+@spanned('show')
 def showInstanceProfiles(ctx, targetRegion, targetEnv, targetRole, targetProfileName, targetId, show_instances):
-    instanceProfiles,instanceProfileByProfileId = aws_profiles.getAllInstanceProfiles(ctx)
+    if targetProfileName != None and not show_instances and not ctx.snapshotLoaded:
+        instanceProfiles,_ = aws_profiles.getInstanceProfile(ctx, targetProfileName)
+    else:
+        instanceProfiles = aws_profiles.iterInstanceProfiles(ctx)
 
     if show_instances:
-        instances, instancesByProfileId = aws_instances.getInstances(ctx, targetRegion, targetEnv )
+        instancesByProfileId = summarizeInstances(ctx, targetRegion, targetEnv)
 
+    profileIds = set()
     for profile in instanceProfiles:
-        profileName = profile['InstanceProfileName']
-        profileId = profile['InstanceProfileId']
+        profileName = profile.profileName
+        profileId = profile.profileId
+        profileIds.add(profileId)
 
         if targetProfileName != None and profileName != targetProfileName:
             continue
         if targetId != None and profileId != targetId:
             continue
 
-        region, env, role = utils.regionEnvAndRole(profileName)
-
-        if targetRegion != None and region != targetRegion:
+        if targetRegion != None and profile.region != targetRegion:
             continue
-        if targetEnv != None and env != targetEnv:
+        if targetEnv != None and profile.env != targetEnv:
             continue
-        if targetRole != None and role != targetRole:
+        if targetRole != None and profile.role != targetRole:
             continue
 
         ctx.log('Profile Name: %s   Profile ID: %s' % (profileName, profileId))
         ctx.log('  Attached Roles:')
-        for role in profile['Roles']:
-            ctx.log('    %s' % (role['RoleName']))
+        for roleName in profile.roleNames:
+            ctx.log('    %s' % (roleName))
         if not show_instances:
             continue
         if profileId in instancesByProfileId:
             ctx.log('  Attached Instances:')
-            for instance in instancesByProfileId[profileId]:
-                fullName = aws_instances.getTag(ctx,instance['Tags'], 'FullName')
+            for fullName, state in instancesByProfileId[profileId]:
                 ctx.log('    %s' % (fullName))
         else:
             ctx.log('  No Attached Instances:')
@@ -55,21 +72,16 @@ def showInstanceProfiles(ctx, targetRegion, targetEnv, targetRole, targetProfile
         return
     if 'NO_INSTANCE_PROFILE' in instancesByProfileId:
         ctx.log('The following instances have no profile id')
-        for instance in instancesByProfileId['NO_INSTANCE_PROFILE']:
-            fullName = aws_instances.getTag(ctx,instance['Tags'], 'FullName')
-            state = instance['State']['Name']
+        for fullName, state in instancesByProfileId['NO_INSTANCE_PROFILE']:
             ctx.log('    %-30s  State: %s' % (fullName, state))
     else:
         ctx.log('All instances have a profile id')
 
     badIds = []
-    for instance in instances:
-        if 'IamInstanceProfile' not in instance:
+    for profileId in instancesByProfileId:
+        if profileId == 'NO_INSTANCE_PROFILE' or profileId in profileIds:
             continue
-        profileId = instance['IamInstanceProfile']['Id']
-        if profileId not in instanceProfileByProfileId:
-            fullName = aws_instances.getTag(ctx,instance['Tags'], 'FullName')
-            state = instance['State']['Name']
+        for fullName, state in instancesByProfileId[profileId]:
             badIds.append({'fullName':fullName,'state':state, 'profileId':profileId})
 
     if len(badIds) > 0:
@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+import awsutils.roles as aws_roles
+import awsutils.policies as aws_policies
+from utils.instrument import spanned
+
+'''
+Role reconciliation for 'roles update'.
+
+planRoleChanges works out the complete set of changes for every targeted
+model role before anything is touched.  applyRoleChanges then runs one work
+unit per role on a pool of ctx.workers threads.  Roles are independent of each
+other, but within a role the steps keep their order: create the role and its
+instance profile, then attach the missing policies, then detach the extra
+ones.
+'''
+
+class RoleChange(object):
+    def __init__(self, roleName, create, attach, detach):
+        self.roleName = roleName
+        self.create = create
+        self.attach = attach
+        self.detach = detach
+
+    def isEmpty(self):
+        return not self.create and len(self.attach) == 0 and len(self.detach) == 0
+
+
+@spanned('plan')
+def planRoleChanges(ctx, targets, constrainToModel):
+    changes = []
+    for role, policyList in targets:
+        create = not aws_roles.isRoleInAWS(ctx, role)
+        if create:
+            ctx.vlog('Adding missing role to AWS: %s' % role)
+            attached = set()
+        else:
+            ctx.log('Model role found in AWS: ' + role)
+            attached = set(aws_roles.getAttachedPolicies(ctx, role))
+
+        attach = []
+        for policyName in policyList:
+            if policyName not in attached and policyName not in attach:
+                attach.append(policyName)
+
+        detach = []
+        if constrainToModel:
+            # Remove attached policies that are not in the model
+            detach = sorted(attached.difference(policyList))
+
+        for policyName in attach:
+            ctx.log('-- Attaching policy: %s' % policyName)
+        for policyName in detach:
+            ctx.log('-- Unattaching policy: %s' % policyName)
+
+        change = RoleChange(role, create, attach, detach)
+        if not change.isEmpty():
+            changes.append(change)
+    return changes
+
+
+def applyRoleChange(ctx, change):
+    if change.create:
+        aws_roles.createRole(ctx, change.roleName)
+        if not aws_roles.isRoleInAWS(ctx, change.roleName):
+            # In dry_run mode the role is not actually created, so
+            # there is nothing to attach policies to.
+            return
+    for policyName in change.attach:
+        aws_roles.attachPolicy(ctx, change.roleName, policyName)
+    for policyName in change.detach:
+        aws_roles.detachPolicy(ctx, change.roleName, policyName)
+
+
+@spanned('apply')
+def applyRoleChanges(ctx, changes):
+    if len(changes) == 0:
+        return
+    # Look up every policy once, up front, rather than from the workers
+    for change in changes:
+        for policyName in change.attach + change.detach:
+            aws_policies.getPolicyMeta(ctx, policyName)
+
+    ctx.vlog('applyRoleChanges: Updating %d roles with %d workers' % (len(changes), ctx.workers))
+    with ThreadPoolExecutor(max_workers=ctx.workers) as pool:
+        futures = []
+        for change in changes:
+            futures.append(pool.submit(applyRoleChange, ctx, change))
+        for future in futures:
+            future.result()
@@ -2,10 +2,13 @@ import sys
 import os.path
 import json
 import click
+from collections import OrderedDict
 import awsutils.roles as aws_roles
 import awsutils.policies as aws_policies
 import csmutils.policies as csm_policies
+import csmutils.reconcile as csm_reconcile
 import utils.utils as utils
+from utils.instrument import spanned
 
 '''
 The envs.json data contains the following:
@@ -27,6 +30,7 @@ def getAWSRoles(ctx):
     aws_roles.getAllRoles(ctx)
 
 
+@spanned('apply')
 def deleteRole(ctx, role):
     aws_roles.deleteRole(ctx, role)
 
@@ -36,7 +40,8 @@ Look to see if all the roles in the model exist, and there are no
 roles that exist outside the model
 Model role us-west-2-prod-signal-transmitter
 '''
-def compareModelRoles(ctx, targetRegion, targetEnv, targetRole, isAudit, no_diff, diff_type, context_lines):
+def targetModelRoles(ctx, targetRegion, targetEnv, targetRole):
+    targets = []
     ctxRoles = ctx.model['roles']
     for region in ctxRoles:
         if targetRegion != None and region != targetRegion:
@@ -48,46 +53,76 @@ def compareModelRoles(ctx, targetRegion, targetEnv, targetRole, isAudit, no_diff
             for role in ctxRoles[region][env]:
                 if targetRole != None and role != targetRole:
                     continue
-                ctx.log('Model role %-34s' % role, nl=False, bold=True)
-                if not aws_roles.isRoleInAWS(ctx,role):
-                    ctx.log('NOT FOUND!', fg='red')
+                if ctx.impactRoles != None and role not in ctx.impactRoles:
                     continue
+                targets.append((role, ctxRoles[region][env][role]))
+    return targets
 
-                ctx.log('     FOUND', bold=True)
-
-                policies = set(ctxRoles[region][env][role])
-                if isAudit:
-                    for policyName in policies:
-                        csm_policies.comparePolicy(ctx, policyName, no_diff, diff_type, context_lines, '    ')
-
-                attached = set(aws_roles.getAttachedPolicies(ctx, role))
-                missing = policies.difference(attached)
-
-                if len(missing) > 0:
-                    ctx.log('    -- Model policies not attached:', fg='cyan')
-                    for policyName in missing:
-                        ctx.log('       %s' % policyName)
-
-                extra = attached.difference(policies)
-                if len(extra) > 0:
-                    ctx.log('    -- Attached policies not in model:', fg='cyan')
-                    for policyName in extra:
-                        ctx.log('       %s' % policyName)
-
-
-def compareAWSRoles(ctx, targetRegion, targetEnv, targetRole):
-    extraRoles = []
-    for role in ctx.currentRoles:
-        roleName = role['RoleName']
-        if targetRole != None and roleName != targetRole:
-            continue
-        region, env, _ = utils.regionEnvAndRole(roleName)
-        if targetRegion != None and region != targetRegion:
+@spanned('compare')
+def compareModelRoles(ctx, targetRegion, targetEnv, targetRole, isAudit, no_diff, diff_type, context_lines):
+    targets = targetModelRoles(ctx, targetRegion, targetEnv, targetRole)
+    if isAudit:
+        wanted = []
+        for role, policies in targets:
+            if aws_roles.isRoleInAWS(ctx, role):
+                wanted.extend(policies)
+        aws_policies.prefetchPolicyDocuments(ctx, wanted)
+
+    for role, policyList in targets:
+        if ctx.jsonl():
+            emitRoleComparison(ctx, role, policyList, isAudit, no_diff, diff_type, context_lines)
             continue
-        if targetEnv != None and env != targetEnv:
+        ctx.log('Model role %-34s' % role, nl=False, bold=True)
+        if not aws_roles.isRoleInAWS(ctx,role):
+            ctx.log('NOT FOUND!', fg='red')
             continue
-        if not isRoleInModel(ctx, roleName):
-            extraRoles.append(roleName)
+
+        ctx.log('     FOUND', bold=True)
+
+        policies = set(policyList)
+        if isAudit:
+            for policyName in policyList:
+                csm_policies.comparePolicy(ctx, policyName, no_diff, diff_type, context_lines, '    ')
+
+        attached = set(aws_roles.getAttachedPolicies(ctx, role))
+        missing = policies.difference(attached)
+
+        if len(missing) > 0:
+            ctx.log('    -- Model policies not attached:', fg='cyan')
+            for policyName in sorted(missing):
+                ctx.log('       %s' % policyName)
+
+        extra = attached.difference(policies)
+        if len(extra) > 0:
+            ctx.log('    -- Attached policies not in model:', fg='cyan')
+            for policyName in sorted(extra):
+                ctx.log('       %s' % policyName)
+
+
+def emitRoleComparison(ctx, role, policyList, isAudit, no_diff, diff_type, context_lines):
+    ''' The --output jsonl form of one model role, followed by its policies when auditing '''
+    record = OrderedDict([('type', 'role'), ('role', role)])
+    if not aws_roles.isRoleInAWS(ctx,role):
+        record['status'] = 'missing'
+        ctx.emit(record)
+        return
+    policies = set(policyList)
+    attached = set(aws_roles.getAttachedPolicies(ctx, role))
+    record['status'] = 'found'
+    record['missingPolicies'] = sorted(policies.difference(attached))
+    record['extraPolicies'] = sorted(attached.difference(policies))
+    ctx.emit(record)
+    if isAudit:
+        for policyName in policyList:
+            csm_policies.comparePolicy(ctx, policyName, no_diff, diff_type, context_lines, '', role)
+
+@spanned('compare')
+def compareAWSRoles(ctx, targetRegion, targetEnv, targetRole):
+    extraRoles = extraAWSRoles(ctx, targetRegion, targetEnv, targetRole)
+    if ctx.jsonl():
+        for roleName in extraRoles:
+            ctx.emit(OrderedDict([('type', 'role'), ('role', roleName), ('status', 'extra')]))
+        return
     if len(extraRoles) > 0:
         ctx.log('AWS Roles NOT in Model:', fg='cyan')
         for roleName in extraRoles:
@@ -112,58 +147,21 @@ def auditRoles(ctx, targetRegion, targetEnv, targetRole, no_diff, diff_type, con
 
 
 def updateModelRoles(ctx, targetRegion, targetEnv, targetRole, constrainToModel):
-    ctxRoles = ctx.model['roles']
-    for region in ctxRoles:
-        if targetRegion != None and region != targetRegion:
-            continue
-        for env in ctxRoles[region]:
-            #defaults = None
-            if targetEnv != None and env != targetEnv:
-                continue
-            for role in ctxRoles[region][env]:
-                if targetRole != None and role != targetRole:
-                    continue
-                if not aws_roles.isRoleInAWS(ctx, role):
-                    ctx.vlog('Adding missing role to AWS: %s' % role)
-                    aws_roles.createRole(ctx, role)
-                    if ctx.dry_run:
-                        # Since we are not actually creating the role in
-                        # dry_run mode, we can't try to attach policies.
-                        continue
-                else:
-                    ctx.log('Model role found in AWS: ' + role)
-
-                policies = set(ctxRoles[region][env][role])
-                attached = set(aws_roles.getAttachedPolicies(ctx, role))
-
-                missing = policies.difference(attached)
-                if len(missing) > 0:
-                    for policyName in missing:
-                        ctx.log('-- Attaching policy: %s' % policyName)
-                        aws_roles.attachPolicy(ctx, role, policyName)
-
-                if not constrainToModel:
-                    continue
+    targets = targetModelRoles(ctx, targetRegion, targetEnv, targetRole)
+    changes = csm_reconcile.planRoleChanges(ctx, targets, constrainToModel)
+    csm_reconcile.applyRoleChanges(ctx, changes)
 
-                # Remove attached policies that are not in the model
-                extra = attached.difference(policies)
-                if len(extra) > 0:
-                    for policyName in extra:
-                        ctx.log('-- Unattaching policy: %s' % policyName)
-                        aws_roles.detachPolicy(ctx, role, policyName)
+def extraAWSRoles(ctx, targetRegion, targetEnv, targetRole):
+    extraRoles = []
+    for role in ctx.findRoles(targetRegion, targetEnv, targetRole):
+        if not isModelRole(ctx, role):
+            extraRoles.append(role.roleName)
+    return extraRoles
 
+@spanned('apply')
 def updateAWSRoles(ctx, targetRegion, targetEnv, targetRole):
-    for role in ctx.currentRoles:
-        roleName = role['RoleName']
-        if targetRole != None and roleName != targetRole:
-            continue
-        region, env, _ = utils.regionEnvAndRole(roleName)
-        if targetRegion != None and region != targetRegion:
-            continue
-        if targetEnv != None and env != targetEnv:
-            continue
-        if not isRoleInModel(ctx, roleName):
-            aws_roles.deleteRole(ctx,roleName)
+    for roleName in extraAWSRoles(ctx, targetRegion, targetEnv, targetRole):
+        aws_roles.deleteRole(ctx,roleName)
 
 
 
@@ -173,32 +171,29 @@ def updateRoles(ctx, targetRegion, targetEnv, targetRole, constrainToModel):
         updateAWSRoles(ctx, targetRegion, targetEnv, targetRole)
 
 
+@spanned('show')
 def showRoles(ctx, targetRegion, targetEnv, targetRole):
-    for role in ctx.currentRoles:
-        roleName = role['RoleName']
-        if targetRole != None and roleName != targetRole:
-            continue
-        region, env, _ = utils.regionEnvAndRole(roleName)
-        if targetRegion != None and region != targetRegion:
-            continue
-        if targetEnv != None and env != targetEnv:
-            continue
-        attached = aws_roles.getAttachedPolicies(ctx, roleName)
+    targets = []
+    for role in ctx.findRoles(targetRegion, targetEnv, targetRole):
+        roleName = role.roleName
+        targets.append((roleName, aws_roles.getAttachedPolicies(ctx, roleName)))
+
+    wanted = []
+    for roleName, attached in targets:
+        wanted.extend(attached)
+    aws_policies.prefetchPolicyDocuments(ctx, wanted)
+
+    for roleName, attached in targets:
         ctx.log('Role: %s: %d attached policies:' % (roleName, len(attached)))
         for policyName in attached:
             policyDoc = csm_policies.getAWSPolicyDocument(ctx,policyName)
-            utils.showPolicyJson(ctx, policyName, ctx.dumps(policyDoc), 15, 120)
+            ctx.log('%*sPolicy: %s' % (10, '', policyName))
+            utils.showPolicyJson(ctx, ctx.dumps(policyDoc), 15, 120)
         ctx.log('')
 
-def isRoleInModel(ctx, roleName):
-    try:
-        region, env, _ = utils.regionEnvAndRole(roleName)
-        if env not in ctx.model['roles'][region]:
-            return False
-        else:
-            if roleName not in ctx.model['roles'][region][env]:
-                return False
-            else:
-                return True
-    except:
+def isModelRole(ctx, role):
+    ''' Whether the record of an AWS role is a role of the model '''
+    ctxRoles = ctx.model['roles']
+    if role.region not in ctxRoles or role.env not in ctxRoles[role.region]:
         return False
+    return role.roleName in ctxRoles[role.region][role.env]
@@ -0,0 +1,144 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+'''
+Persistent IAM state cache, stored as a small sqlite database under the
+cache folder.
+
+Policy documents are keyed by account, policy ARN and version id.  AWS never
+changes the document of an existing policy version, so a cached document is
+never refetched.  Policy metadata is kept per account together with its
+UpdateDate, so it can be revalidated against a cheap list_policies pass.  The
+role snapshot (roles, attached policies and instance profiles) is kept per
+account so that the tool can run offline.
+
+Rendered model and policy documents are kept by a hash of everything that
+went into rendering them: the template sources, including the templates they
+include, and the render inputs.  An entry is never stale, it is simply no
+longer looked up once a template or an input changes.
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS policy_docs (
+    org_id TEXT NOT NULL,
+    policy_arn TEXT NOT NULL,
+    version_id TEXT NOT NULL,
+    document TEXT NOT NULL,
+    PRIMARY KEY (org_id, policy_arn, version_id)
+);
+CREATE TABLE IF NOT EXISTS policy_meta (
+    org_id TEXT NOT NULL,
+    policy_arn TEXT NOT NULL,
+    update_date TEXT,
+    meta TEXT NOT NULL,
+    PRIMARY KEY (org_id, policy_arn)
+);
+CREATE TABLE IF NOT EXISTS entities (
+    org_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (org_id, kind)
+);
+CREATE TABLE IF NOT EXISTS rendered (
+    kind TEXT NOT NULL,
+    render_key TEXT NOT NULL,
+    document TEXT NOT NULL,
+    PRIMARY KEY (kind, render_key)
+);
+'''
+
+def defaultCacheDir():
+    base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'iam-policy-manager')
+
+def encodeValue(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def dumpValue(obj):
+    return json.dumps(obj, default=encodeValue, separators=(',', ':'))
+
+def updateDate(meta):
+    value = meta.get('UpdateDate')
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class StateCache(object):
+    def __init__(self, cacheDir):
+        os.makedirs(cacheDir, exist_ok=True)
+        self.path = os.path.join(cacheDir, 'state.db')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def getDocument(self, orgId, policyArn, versionId):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT document FROM policy_docs WHERE org_id=? AND policy_arn=? AND version_id=?',
+                (orgId, policyArn, versionId)).fetchone()
+        if row == None:
+            return None
+        return json.loads(row[0])
+
+    def putDocument(self, orgId, policyArn, versionId, document):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO policy_docs VALUES (?,?,?,?)',
+                (orgId, policyArn, versionId, dumpValue(document)))
+
+    def getPolicyMetas(self, orgId):
+        metas = {}
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT policy_arn, meta FROM policy_meta WHERE org_id=?', (orgId,)).fetchall()
+        for policyArn, meta in rows:
+            metas[policyArn] = json.loads(meta)
+        return metas
+
+    def putPolicyMetas(self, orgId, metas):
+        ''' Replaces all of the cached policy metadata for the account '''
+        with self.lock:
+            self.db.execute('DELETE FROM policy_meta WHERE org_id=?', (orgId,))
+            self.db.executemany(
+                'INSERT INTO policy_meta VALUES (?,?,?,?)',
+                [(orgId, meta['Arn'], updateDate(meta), dumpValue(meta)) for meta in metas])
+
+    def getEntities(self, orgId, kind):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data FROM entities WHERE org_id=? AND kind=?', (orgId, kind)).fetchone()
+        if row == None:
+            return None
+        return json.loads(row[0])
+
+    def putEntities(self, orgId, kind, data):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO entities VALUES (?,?,?)', (orgId, kind, dumpValue(data)))
+
+    def getRendered(self, kind, renderKey):
+        ''' The rendered JSON text, not decoded, so callers pick the dict type '''
+        with self.lock:
+            row = self.db.execute(
+                'SELECT document FROM rendered WHERE kind=? AND render_key=?', (kind, renderKey)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def putRendered(self, kind, renderKey, document):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO rendered VALUES (?,?,?)', (kind, renderKey, document))
+
+    def hasSnapshot(self, orgId):
+        return self.getEntities(orgId, 'roles') != None
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
@@ -1,15 +1,24 @@
 import sys
+import threading
 import os.path
 import boto3
+from botocore.config import Config
 import json
 import click
 from datetime import datetime
+from collections import OrderedDict
+from utils.instrument import Instrumentation
+from awsutils.ratelimit import RateLimiter
+
+# Throttled calls are retried by the SDK, with backoff, on top of the rate limiter
+clientConfig = Config(retries={'mode': 'standard', 'max_attempts': 10})
 
 
 class CSMContext(object):
     def __init__(self):
         self.prettyprint = False
         self.verbose = False
+        self.output = 'text'
         self.orgId=None
         self.dry_run = False
         self.region = None
@@ -19,10 +28,34 @@ class CSMContext(object):
         self.modelDir = None
         self.modelFile = None
         self.model = None
-        self.currentRoles = []
+        self.rolesByName = OrderedDict()
+        self.rolesByPath = {}
         self.awsPolicyMeta = {}
+        self.policiesByArn = {}
         self.awsPolicyDocs = {}
+        # Compare results by model and AWS document hash, see csmutils.policies
+        self.comparisons = {}
+        self.attachedPolicies = {}
+        self.instanceProfiles = {}
+        self.profilesByRole = {}
+        self.lock = threading.RLock()
+        self.policyVersions = {}
+        self.snapshotLoaded = False
+        self.activeInstancesByProfileId = None
+        self.cacheDir = None
+        self.cache = None
+        self.refresh = False
+        self.offline = False
+        self.workers = 8
+        self.renderProcesses = 0
+        self.backend = None
+        self.backendSpec = 'aws'
+        self.instrumentation = Instrumentation()
+        self.rateLimiter = None
         self.modelPolicies=None
+        # Set by --changed_since to the names affected by template changes
+        self.impactPolicies = None
+        self.impactRoles = None
         self.templateDir = None
         self.templates = {}
         self.templateExcludes = ['default', 'snippets']
@@ -38,6 +71,112 @@ class CSMContext(object):
     def policyArn(self, serviceName):
         return '%s/%s' % (self.basePolicyArn(), self.roleName(serviceName))
 
+    '''
+    Indexed views of the AWS entities, held as the records of
+    awsutils.records.  All additions and removals go through the methods
+    below so that the indexes stay consistent.
+    '''
+    @property
+    def currentRoles(self):
+        return list(self.rolesByName.values())
+
+    def regionEnvOfPath(self, path):
+        # Paths are /<region>/<env>/<role>/ for roles that follow the model
+        parts = path.strip('/').split('/')
+        if len(parts) < 2:
+            return None, None
+        return parts[0], parts[1]
+
+    def addRole(self, role):
+        with self.lock:
+            roleName = role.roleName
+            if roleName in self.rolesByName:
+                oldKey = self.regionEnvOfPath(self.rolesByName[roleName].path)
+                self.rolesByPath[oldKey].pop(roleName, None)
+            self.rolesByName[roleName] = role
+            key = self.regionEnvOfPath(role.path)
+            if key not in self.rolesByPath:
+                self.rolesByPath[key] = OrderedDict()
+            self.rolesByPath[key][roleName] = role
+
+    def removeRole(self, roleName):
+        with self.lock:
+            role = self.rolesByName.pop(roleName, None)
+            if role == None:
+                return
+            key = self.regionEnvOfPath(role.path)
+            self.rolesByPath[key].pop(roleName, None)
+            self.attachedPolicies.pop(roleName, None)
+
+    def getRole(self, roleName):
+        return self.rolesByName.get(roleName)
+
+    def findRoles(self, region=None, env=None, roleName=None):
+        if roleName != None:
+            role = self.rolesByName.get(roleName)
+            if role == None:
+                return []
+            candidates = {self.regionEnvOfPath(role.path): {roleName: role}}
+        else:
+            candidates = self.rolesByPath
+        roles = []
+        for key in candidates:
+            if region != None and key[0] != region:
+                continue
+            if env != None and key[1] != env:
+                continue
+            roles.extend(candidates[key].values())
+        return roles
+
+    def addPolicy(self, meta):
+        with self.lock:
+            self.awsPolicyMeta[meta.policyName] = meta
+            self.policiesByArn[meta.arn] = meta
+
+    def removePolicy(self, policyName):
+        with self.lock:
+            meta = self.awsPolicyMeta.pop(policyName, None)
+            if meta == None:
+                return
+            self.policiesByArn.pop(meta.arn, None)
+            self.awsPolicyDocs.pop(policyName, None)
+            self.policyVersions.pop(meta.arn, None)
+
+    def getPolicyByArn(self, policyArn):
+        return self.policiesByArn.get(policyArn)
+
+    def addInstanceProfile(self, profile):
+        with self.lock:
+            profileId = profile.profileId
+            self.instanceProfiles[profileId] = profile
+            for roleName in profile.roleNames:
+                self.profilesByRole.setdefault(roleName, OrderedDict())[profileId] = profile
+
+    def removeInstanceProfile(self, profileName):
+        with self.lock:
+            for profileId, profile in list(self.instanceProfiles.items()):
+                if profile.profileName != profileName:
+                    continue
+                del self.instanceProfiles[profileId]
+                for roleName in profile.roleNames:
+                    self.profilesByRole.get(roleName, {}).pop(profileId, None)
+
+    def removeRoleFromInstanceProfile(self, roleName, profileName):
+        with self.lock:
+            for profileId in list(self.profilesByRole.get(roleName, {})):
+                profile = self.instanceProfiles[profileId]
+                if profile.profileName != profileName:
+                    continue
+                del self.profilesByRole[roleName][profileId]
+                # The other roles of the profile see the new record too
+                profile = profile.withoutRole(roleName)
+                self.instanceProfiles[profileId] = profile
+                for otherRole in profile.roleNames:
+                    self.profilesByRole[otherRole][profileId] = profile
+
+    def getInstanceProfilesForRole(self, roleName):
+        return list(self.profilesByRole.get(roleName, {}).values())
+
     def log(self, text, nl=True, err=False, color=None, **styles):
         """Logs a message to stderr."""
         click.secho(text, file=sys.stderr, nl=nl, err=err, color=color, **styles)
@@ -47,6 +186,16 @@ class CSMContext(object):
         text2 = '[%s]: %s' % (datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S,%f%z"),text)
         self.log(text2, nl=nl, err=err, color=color, **styles)
 
+    def jsonl(self):
+        return self.output == 'jsonl'
+
+    def emit(self, record):
+        """Writes one JSON record to stdout as soon as it is known."""
+        line = json.dumps(record, separators=(',', ':'))
+        with self.lock:
+            sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+
     def vlog(self, text, nl=True, err=False, color=None, **styles):
         """Logs a message to stderr only if verbose is enabled."""
         if self.verbose:
@@ -58,9 +207,46 @@ class CSMContext(object):
         else:
             return json.dumps(j)
 
+    def span(self, name):
+        """Times a phase of the command, see utils.instrument."""
+        return self.instrumentation.span(name)
+
+    def setRateLimits(self, rates):
+        """Limits the rate of the AWS calls, see awsutils.ratelimit."""
+        self.rateLimiter = RateLimiter(rates)
+        self.instrumentation.rateLimiter = self.rateLimiter
+
+    def instrumentClients(self):
+        for client in [self.iam, self.ec2]:
+            if self.rateLimiter != None:
+                self.rateLimiter.install(client)
+            self.instrumentation.install(client)
+
     def setDefaultClients(self):
-        self.iam = boto3.client('iam')
-        self.ec2 = boto3.client('ec2')
+        self.iam = boto3.client('iam', config=clientConfig)
+        self.ec2 = boto3.client('ec2', config=clientConfig)
+        self.instrumentClients()
+
+    def setFixtureClients(self, spec):
+        """Serves the iam and ec2 clients from recorded fixtures, see awsutils.fixtures."""
+        from awsutils.fixtures import installFixtureClients
+        installFixtureClients(self, spec)
+        self.instrumentClients()
+
+    def setAssumedRoleClients(self, roleArn, sessionName):
+        """Creates the clients with the credentials of an assumed role, in self.region."""
+        sts_connection = boto3.client('sts', config=clientConfig)
+        credentials = sts_connection.assume_role(RoleArn=roleArn, RoleSessionName=sessionName)['Credentials']
+        for service in ['iam', 'ec2']:
+            client = boto3.client(
+                service,
+                region_name=self.region,
+                config=clientConfig,
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'])
+            setattr(self, service, client)
+        self.instrumentClients()
 
     def getTempCredentials(self):
         mfa_deviceId = click.prompt("Enter Your AWS user name: ")
@@ -72,11 +258,14 @@ class CSMContext(object):
             TokenCode=mfa_TOTP)
         self.iam = boto3.client(
             'iam',
+            config=clientConfig,
             aws_access_key_id=tempCredentials['Credentials']['AccessKeyId'],
             aws_secret_access_key=tempCredentials['Credentials']['SecretAccessKey'],
             aws_session_token=tempCredentials['Credentials']['SessionToken'])
         self.ec2 = boto3.client(
             'ec2',
+            config=clientConfig,
             aws_access_key_id=tempCredentials['Credentials']['AccessKeyId'],
             aws_secret_access_key=tempCredentials['Credentials']['SecretAccessKey'],
             aws_session_token=tempCredentials['Credentials']['SessionToken'])
+        self.instrumentClients()
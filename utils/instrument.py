@@ -0,0 +1,264 @@
+import json
+import time
+import threading
+import functools
+import contextlib
+from collections import OrderedDict
+import click
+from awsutils.retry import throttleCodes
+
+'''
+Instrumentation for CSMContext.
+
+Spans time the phases of a command: template load, model render, AWS
+discovery, compare, plan and apply.  Spans nest, and each one is recorded
+under its path (e.g. 'compare/render'), with its count, its total time, and
+its self time excluding nested spans.
+
+Every AWS call is counted per operation from botocore's client events, so all
+of awsutils is covered without touching the call sites.  For each operation
+we keep the number of calls, errors, SDK retries, throttling errors, response
+bytes (known only for real HTTP responses), and a histogram of call latencies.
+When a rate limiter is set, its buckets are reported too, with the time spent
+waiting for them.
+'''
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class SpanStats(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.childSeconds = 0.0
+
+    def report(self):
+        return {
+            'count': self.count,
+            'seconds': round(self.seconds, 6),
+            'selfSeconds': round(self.seconds - self.childSeconds, 6),
+        }
+
+
+class OperationStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.maxSeconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        self.maxSeconds = max(self.maxSeconds, seconds)
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds * 1000 > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def percentile(self, fraction):
+        ''' Upper bound, in milliseconds, of the bucket holding the percentile '''
+        target = self.calls * fraction
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= target and count > 0:
+                if bucket < len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[bucket]
+                return round(self.maxSeconds * 1000, 3)
+        return 0
+
+    def report(self):
+        histogram = OrderedDict()
+        for bucket, count in enumerate(self.histogram):
+            if bucket < len(LATENCY_BUCKETS):
+                histogram['<=%dms' % LATENCY_BUCKETS[bucket]] = count
+            else:
+                histogram['>%dms' % LATENCY_BUCKETS[-1]] = count
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'throttles': self.throttles,
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 6),
+            'maxMs': round(self.maxSeconds * 1000, 3),
+            'p50Ms': self.percentile(0.5),
+            'p90Ms': self.percentile(0.9),
+            'histogram': histogram,
+        }
+
+
+def spanned(name):
+    ''' Decorator that runs a function taking ctx first inside a span '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(ctx, *args, **kwargs):
+            with ctx.span(name):
+                return fn(ctx, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def treeOrder(paths):
+    ''' Span paths with every span directly followed by its children '''
+    children = OrderedDict()
+    roots = []
+    for path in paths:
+        parent, _, name = path.rpartition('/')
+        children.setdefault(path, [])
+        if parent == '':
+            roots.append(path)
+        else:
+            children.setdefault(parent, []).append(path)
+    ordered = []
+    pending = list(reversed(roots))
+    while len(pending) > 0:
+        path = pending.pop()
+        ordered.append(path)
+        pending.extend(reversed(children[path]))
+    return ordered
+
+
+class Instrumentation(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.perf_counter()
+        self.spans = OrderedDict()
+        self.operations = OrderedDict()
+        self.rateLimiter = None
+
+    '''
+    Spans
+    '''
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def span(self, name):
+        stack = self.stack()
+        if len(stack) > 0:
+            path = stack[-1] + '/' + name
+        else:
+            path = name
+        stack.append(path)
+        with self.lock:
+            # Created on entry, so that the report lists parents first
+            if path not in self.spans:
+                self.spans[path] = SpanStats()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                stats = self.spans[path]
+                stats.count += 1
+                stats.seconds += seconds
+                if len(stack) > 0:
+                    self.spans[stack[-1]].childSeconds += seconds
+
+    '''
+    botocore client events.  The call is timed from parameter building to
+    after-call, which botocore emits for error responses too, less the time
+    it waited for the rate limiter.
+    '''
+    def install(self, client):
+        client.meta.events.register('before-parameter-build', self.beforeCall)
+        client.meta.events.register('after-call', self.afterCall)
+        client.meta.events.register('after-call-error', self.afterCallError)
+
+    def operationStats(self, model):
+        key = '%s.%s' % (model.service_model.endpoint_prefix, model.name)
+        stats = self.operations.get(key)
+        if stats == None:
+            stats = self.operations[key] = OperationStats()
+        return stats
+
+    def beforeCall(self, context, **kwargs):
+        context['instrumentStart'] = time.perf_counter()
+
+    def callSeconds(self, context):
+        seconds = time.perf_counter() - context.get('instrumentStart', time.perf_counter())
+        return max(0.0, seconds - context.get('rateLimitWait', 0.0))
+
+    def afterCall(self, http_response, parsed, model, context, **kwargs):
+        seconds = self.callSeconds(context)
+        size = 0
+        if getattr(http_response, 'raw', None) != None:
+            size = len(http_response.content or b'')
+        metadata = parsed.get('ResponseMetadata', {})
+        code = parsed.get('Error', {}).get('Code')
+        with self.lock:
+            stats = self.operationStats(model)
+            stats.record(seconds)
+            stats.bytes += size
+            stats.retries += metadata.get('RetryAttempts', 0)
+            if http_response.status_code >= 300:
+                stats.errors += 1
+            if code in throttleCodes:
+                stats.throttles += 1
+
+    def afterCallError(self, model, context, **kwargs):
+        seconds = self.callSeconds(context)
+        with self.lock:
+            stats = self.operationStats(model)
+            stats.record(seconds)
+            stats.errors += 1
+
+    '''
+    Reporting
+    '''
+    def report(self):
+        with self.lock:
+            spans = OrderedDict((path, stats.report()) for path, stats in self.spans.items())
+            operations = OrderedDict((key, stats.report()) for key, stats in sorted(self.operations.items()))
+        report = {
+            'seconds': round(time.perf_counter() - self.started, 6),
+            'spans': spans,
+            'operations': operations,
+        }
+        if self.rateLimiter != None:
+            report['rateLimits'] = self.rateLimiter.report()
+        return report
+
+    def writeJson(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def printTable(self, file=None):
+        report = self.report()
+        lines = []
+        lines.append('Profile: %.3fs total' % report['seconds'])
+        lines.append('%-40s %8s %10s %10s' % ('Phase', 'Count', 'Total s', 'Self s'))
+        for path in treeOrder(report['spans']):
+            stats = report['spans'][path]
+            depth = path.count('/')
+            name = '%*s%s' % (2 * depth, '', path.split('/')[-1])
+            lines.append('%-40s %8d %10.3f %10.3f' % (name, stats['count'], stats['seconds'], stats['selfSeconds']))
+        lines.append('')
+        lines.append('%-40s %7s %6s %7s %9s %10s %9s %8s %8s %8s' % (
+            'AWS operation', 'Calls', 'Errors', 'Retries', 'Throttles', 'KiB', 'Total s', 'p50 ms', 'p90 ms', 'Max ms'))
+        for key, stats in report['operations'].items():
+            lines.append('%-40s %7d %6d %7d %9d %10.1f %9.3f %8s %8s %8.1f' % (
+                key, stats['calls'], stats['errors'], stats['retries'], stats['throttles'],
+                stats['bytes'] / 1024.0, stats['seconds'], '<=%s' % stats['p50Ms'], '<=%s' % stats['p90Ms'],
+                stats['maxMs']))
+        if 'rateLimits' in report:
+            lines.append('')
+            lines.append('%-40s %7s %9s %7s %10s %9s %11s' % (
+                'Rate limit', 'Calls', 'Throttles', 'Waits', 'Wait s', 'Rate/s', 'Lowest/s'))
+            for key, stats in report['rateLimits'].items():
+                lines.append('%-40s %7d %9d %7d %10.3f %9.2f %11.2f' % (
+                    key, stats['calls'], stats['throttles'], stats['waits'], stats['waitSeconds'],
+                    stats['rate'], stats['lowestRate']))
+        click.echo('\n'.join(lines), file=file, err=file == None)
@@ -1,10 +1,171 @@
 import os
+import re
 import json
 import sys
+import hashlib
 from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 from jinja2 import Template
 from jinja2 import FileSystemLoader
+from jinja2 import FileSystemBytecodeCache
+from jinja2 import meta
 from jinja2.environment import Environment
+from utils.instrument import spanned
+
+'''
+Jinja environments are shared per folder, so each template is read and
+compiled at most once per run.  When a cache folder is configured, compiled
+templates are also kept in a bytecode cache on disk so that later runs do not
+need to compile them at all.
+
+With a state cache, rendered documents are kept too, keyed by renderKey.  A
+template whose source, and the sources of the templates it includes, are
+unchanged renders to the same document for the same inputs, so only the
+documents of changed templates are rendered again.
+'''
+templateEnvironments = {}
+
+class CountingBytecodeCache(FileSystemBytecodeCache):
+    def __init__(self, directory):
+        FileSystemBytecodeCache.__init__(self, directory)
+        self.hits = 0
+
+    def load_bytecode(self, bucket):
+        FileSystemBytecodeCache.load_bytecode(self, bucket)
+        if bucket.code is not None:
+            self.hits += 1
+
+class TemplateEnvironment(Environment):
+    def __init__(self, folder, bytecodeCache=None):
+        Environment.__init__(self, loader=FileSystemLoader(folder),
+            bytecode_cache=bytecodeCache, cache_size=-1, auto_reload=False)
+        self.requests = 0
+        self.compiled = 0
+        self.renderHits = 0
+        self.sourceHashes = {}
+        self.referenceLists = {}
+
+    def get_template(self, name, parent=None, globals=None):
+        self.requests += 1
+        return Environment.get_template(self, name, parent, globals)
+
+    def compile(self, source, name=None, filename=None, raw=False, defer_init=False):
+        self.compiled += 1
+        return Environment.compile(self, source, name, filename, raw, defer_init)
+
+    def references(self, name):
+        ''' Names of the templates a template includes, imports or extends '''
+        if name not in self.referenceLists:
+            source = self.loader.get_source(self, name)[0]
+            references = list(meta.find_referenced_templates(self.parse(source)))
+            if None in references:
+                # Included by a computed name, so it may be any of them
+                references = self.list_templates()
+            self.referenceLists[name] = sorted(set(references) - set([name]))
+        return self.referenceLists[name]
+
+    def sourceHash(self, name):
+        ''' Hash of the source of a template and of every template it includes '''
+        if name not in self.sourceHashes:
+            # Threads share the environment, so the hash is only stored once
+            # it is complete.  It covers every template reachable from this
+            # one, which also ends templates that include each other.
+            reachable = set([name])
+            pending = [name]
+            while len(pending) > 0:
+                for reference in self.references(pending.pop()):
+                    if reference not in reachable:
+                        reachable.add(reference)
+                        pending.append(reference)
+            digest = hashlib.sha256(name.encode('utf-8'))
+            for template in sorted(reachable):
+                source = self.loader.get_source(self, template)[0]
+                digest.update(template.encode('utf-8'))
+                digest.update(hashlib.sha256(source.encode('utf-8')).hexdigest().encode('utf-8'))
+            self.sourceHashes[name] = digest.hexdigest()
+        return self.sourceHashes[name]
+
+    def stats(self):
+        bytecodeHits = 0
+        if self.bytecode_cache != None:
+            bytecodeHits = self.bytecode_cache.hits
+        return self.requests, self.compiled, bytecodeHits, self.renderHits
+
+def getTemplateEnvironment(ctx, folder):
+    if folder not in templateEnvironments:
+        bytecodeCache = None
+        if ctx.cacheDir != None:
+            bytecodeDir = os.path.join(ctx.cacheDir, 'jinja')
+            os.makedirs(bytecodeDir, exist_ok=True)
+            bytecodeCache = CountingBytecodeCache(bytecodeDir)
+        templateEnvironments[folder] = TemplateEnvironment(folder, bytecodeCache)
+    return templateEnvironments[folder]
+
+def logTemplateStats(ctx, caller, folder):
+    if folder not in templateEnvironments:
+        return
+    requests, compiled, bytecodeHits, renderHits = getTemplateEnvironment(ctx, folder).stats()
+    ctx.vlog('%s: %d template loads, %d compiled, %d from bytecode cache, %d from memory, %d renders cached' % (
+        caller, requests, compiled, bytecodeHits, requests - compiled - bytecodeHits, renderHits))
+
+def renderInputs(props):
+    ''' The render properties other than ctx, which are plain values '''
+    return dict((key, value) for key, value in props.items() if key != 'ctx')
+
+def renderKey(ctx, env, templateName, props):
+    inputs = renderInputs(props)
+    # Templates may read these through ctx.  The region of the policy in the
+    # model, in the inputs, may differ from the region of the run.
+    inputs['orgId'] = ctx.orgId
+    inputs['ctxRegion'] = ctx.region
+    inputs['template'] = templateName
+    inputs['source'] = env.sourceHash(templateName)
+    key = json.dumps(inputs, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def cachedRender(ctx, kind, env, templateName, props):
+    ''' Returns (key, doc), where doc is None unless it is in the render cache '''
+    if ctx.cache == None:
+        return None, None
+    key = renderKey(ctx, env, templateName, props)
+    doc = ctx.cache.getRendered(kind, key)
+    if doc == None:
+        return key, None
+    env.renderHits += 1
+    return key, json.loads(doc, object_pairs_hook=OrderedDict)
+
+def storeRender(ctx, kind, key, doc):
+    if key != None:
+        ctx.cache.putRendered(kind, key, json.dumps(doc, separators=(',', ':')))
+
+def renderTemplate(ctx, kind, env, templateName, props):
+    key, doc = cachedRender(ctx, kind, env, templateName, props)
+    if doc != None:
+        return doc
+    doc = json.loads(env.get_template(templateName).render(props), object_pairs_hook=OrderedDict)
+    storeRender(ctx, kind, key, doc)
+    return doc
+
+def renderChunk(templateDir, cacheDir, orgId, region, items):
+    '''
+    Renders (inputsKey, templatePath, inputs) work items in a pool process
+    and returns [(inputsKey, doc)].  Templates see a context holding only
+    the settings that rendering depends on.
+    '''
+    from utils.context import CSMContext
+    ctx = CSMContext()
+    ctx.templateDir = templateDir
+    ctx.cacheDir = cacheDir
+    ctx.orgId = orgId
+    ctx.region = region
+    env = getTemplateEnvironment(ctx, templateDir)
+    results = []
+    for inputsKey, templateName, inputs in items:
+        props = dict(inputs)
+        props['ctx'] = ctx
+        results.append((inputsKey, json.loads(env.get_template(templateName).render(props), object_pairs_hook=OrderedDict)))
+    return results
 
 
 
@@ -13,26 +174,85 @@ def nameAndPath(region, env, roleName):
     path = '/%s/%s/%s/' % (region, env, roleName)
     return name, path
 
+'''
+Names of the model are <region>-<env>-<role>, and those of its policies
+<region>-<env>-<service>.  A region is <area>-<direction>-<number>, as in
+us-west-2 or us-gov-east-1, with its area and direction taken from the
+tables below, so that a name such as my-app-1-x is not read as one.  A
+name that does not follow the model has no region or env.
+
+Each name is parsed once, however many entities and phases look at it.
+NameIndex keeps the parts of a set of names along with the names of each
+region, env and role, so that filters on them are set intersections.
+'''
+regionAreas = ['af', 'ap', 'ca', 'cn', 'eu', 'eu-isoe', 'il', 'me', 'mx', 'sa',
+    'us', 'us-gov', 'us-iso', 'us-isob', 'us-isof']
+regionDirections = ['central', 'east', 'north', 'northeast', 'northwest', 'south',
+    'southeast', 'southwest', 'west']
+
+def alternatives(words):
+    # Longest first, so that us-gov is tried before us
+    return '|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+modelNamePattern = re.compile(r'^((?:%s)-(?:%s)-[0-9]+)-([^-]+)-(.+)$' % (
+    alternatives(regionAreas), alternatives(regionDirections)))
+
+parsedNames = {}
+
 def regionEnvAndRole(name):
-    parts = name.split('-')
-    # 0 - 'us', 1 -' west', 2 - '2', 3 - '<env>', 4 - '<role>'
-    if len(parts) < 4:
-        return None, None, name
-    if parts[0] == 'us' and parts[1] == 'west' and parts[2] == '2':
-        region = '%s-%s-%s'%(parts[0],parts[1],parts[2])
-    else:
-        return None, None, name
-
-    env = parts[3]
-    if len(parts) > 5:
-        role = parts[4]
-        i = 5
-        while i < len(parts):
-            role += '-' + parts[i]
-            i += 1
-    else:
-        role = parts[4]
-    return region, env, role
+    parts = parsedNames.get(name)
+    if parts == None:
+        match = modelNamePattern.match(name)
+        if match == None:
+            parts = (None, None, name)
+        else:
+            parts = match.groups()
+        parsedNames[name] = parts
+    return parts
+
+
+class NameIndex(object):
+    def __init__(self, names=()):
+        self.parts = OrderedDict()
+        self.byRegion = {}
+        self.byEnv = {}
+        self.byRole = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        if name in self.parts:
+            return
+        region, env, role = self.parts[name] = regionEnvAndRole(name)
+        self.byRegion.setdefault(region, set()).add(name)
+        self.byEnv.setdefault(env, set()).add(name)
+        self.byRole.setdefault(role, set()).add(name)
+
+    def discard(self, name):
+        parts = self.parts.pop(name, None)
+        if parts == None:
+            return
+        region, env, role = parts
+        self.byRegion[region].discard(name)
+        self.byEnv[env].discard(name)
+        self.byRole[role].discard(name)
+
+    def __contains__(self, name):
+        return name in self.parts
+
+    def get(self, name):
+        return self.parts.get(name, (None, None, name))
+
+    def select(self, region=None, env=None, role=None):
+        ''' The set of names in the given region, env and role; None matches any '''
+        sets = []
+        for value, index in [(region, self.byRegion), (env, self.byEnv), (role, self.byRole)]:
+            if value != None:
+                sets.append(index.get(value, set()))
+        if len(sets) == 0:
+            return set(self.parts)
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
 
 def policyNameFromArn(ctx, policyArn):
     #arn:aws:iam::716927822216:policy/us-west-2-dev-default
@@ -43,19 +263,19 @@ def policyNameFromArn(ctx, policyArn):
         ctx.vlog('policyNameFromArn: %s -> %s' % (policyArn, parts[-1]))
         return parts[-1]
 
+@spanned('render')
 def renderPolicy(ctx, templateName, options):
     if templateName not in ctx.templates:
         ctx.log('renderPolicy: Error - %s is not in the set of available templates' % templateName)
         sys.exit(1)
+    env = getTemplateEnvironment(ctx, ctx.templateDir)
+    return renderTemplate(ctx, 'policy', env, templatePath(templateName), options)
+
+def templatePath(templateName):
+    ''' Path under the template folder of a template named in the model '''
     if templateName.startswith('default.'):
-        templateName = 'default/%s' % templateName[len('default.'):]
-    env = Environment()
-    env.loader = FileSystemLoader(ctx.templateDir)
-    jt = env.get_template(templateName)
-    #jt = Template(templateName)
-    #jt = Template(ctx.templates[templateName])
-    doc = jt.render(options)
-    return json.loads(doc, object_pairs_hook=OrderedDict)
+        return 'default/%s' % templateName[len('default.'):]
+    return templateName
 
 def policyNameFromModel(ctx, region, env, role, service, policy):
     if policy == 'service' or policy == service:
@@ -72,27 +292,23 @@ def templateNameFromModel(ctx, service, policy):
     return templateName
 
 
+@spanned('model')
 def loadModel(ctx):
     ctx.vlog('loadModel: Start')
     props = {}
     props['ctx'] = ctx
-    env = Environment()
-    env.loader = FileSystemLoader(ctx.modelDir)
-    jt = env.get_template(ctx.modelFile)
-    doc = jt.render(props)
-    model = json.loads(doc, object_pairs_hook=OrderedDict)
-    return model
+    env = getTemplateEnvironment(ctx, ctx.modelDir)
+    return renderTemplate(ctx, 'model', env, ctx.modelFile, props)
 
 
+@spanned('modelPolicies')
 def loadModelPolicies(ctx):
     ctx.vlog('loadModelPolicies: Start')
     if ctx.templates == None:
         ctx.log("Cannot load model policies until templates are loaded")
         sys.exit(1)
-    props = {}
-    props['ctx'] = ctx
 
-    modelPolicies = {}
+    modelPolicies = ModelPolicies(ctx)
     ctxPolicies = ctx.model['policies']
     for region in ctxPolicies:
         for env in ctxPolicies[region]:
@@ -100,15 +316,109 @@ def loadModelPolicies(ctx):
                     for policyName in ctxPolicies[region][env][service]:
                         templateName =  ctxPolicies[region][env][service][policyName]
                         if policyName not in modelPolicies:
-                            props['region'] = ctx.region
+                            props = {}
+                            props['ctx'] = ctx
+                            props['region'] = region
                             props['env'] = env
                             props['service'] = service
-                            modelPolicy = renderPolicy(ctx, templateName, props)
-                            modelPolicies[policyName]=modelPolicy
+                            modelPolicies.add(policyName, templateName, props)
+    if ctx.renderProcesses > 1:
+        modelPolicies.renderInProcesses(ctx.renderProcesses)
     ctx.vlog('loadModelPolicies: Done')
     return modelPolicies
 
+'''
+The rendered model policies, keyed by policy name in model order.  Only the
+index of names, templates and render properties is built up front; each
+policy is rendered the first time it is looked up, and then kept.  Membership
+tests and iteration never render anything.
+
+Policies with the same template and render properties are rendered once, and
+share the document.  Policies rendered from different properties that still
+come out the same, such as the summon policies of services that the template
+does not tell apart, share one interned, frozen document too.  With
+ctx.renderProcesses, every policy is rendered up front instead, on a pool of
+processes.
+'''
+# Work items per process, so that uneven chunks still balance out
+RENDER_CHUNKS_PER_PROCESS = 4
+
+def inputsKey(templateName, props):
+    return json.dumps([templateName, renderInputs(props)], sort_keys=True, separators=(',', ':'))
+
+class ModelPolicies(Mapping):
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.index = OrderedDict()
+        self.rendered = {}
+        self.byInputs = {}
+        self.interned = {}
+        self.names = NameIndex()
+
+    def add(self, policyName, templateName, props):
+        self.index[policyName] = (templateName, props)
+        self.names.add(policyName)
+
+    def __getitem__(self, policyName):
+        if policyName not in self.rendered:
+            templateName, props = self.index[policyName]
+            key = inputsKey(templateName, props)
+            if key not in self.byInputs:
+                self.byInputs[key] = self.intern(renderPolicy(self.ctx, templateName, props))
+            self.rendered[policyName] = self.byInputs[key]
+        return self.rendered[policyName]
+
+    def intern(self, doc):
+        doc = freezeDocument(doc)
+        return self.interned.setdefault(doc.contentHash, doc)
+
+    def renderInProcesses(self, processes):
+        ctx = self.ctx
+        env = getTemplateEnvironment(ctx, ctx.templateDir)
+        work = OrderedDict()
+        cacheKeys = {}
+        for policyName, (templateName, props) in self.index.items():
+            key = inputsKey(templateName, props)
+            if key in self.byInputs or key in work:
+                continue
+            if templateName not in ctx.templates:
+                # Fails the same way as rendering it here would
+                renderPolicy(ctx, templateName, props)
+            path = templatePath(templateName)
+            cacheKeys[key], doc = cachedRender(ctx, 'policy', env, path, props)
+            if doc != None:
+                self.byInputs[key] = self.intern(doc)
+                continue
+            work[key] = (key, path, renderInputs(props))
+
+        ctx.vlog('loadModelPolicies: Rendering %d distinct policies of %d with %d processes' % (
+            len(work), len(self.index), processes))
+        items = list(work.values())
+        size = max(1, -(-len(items) // (processes * RENDER_CHUNKS_PER_PROCESS)))
+        chunks = [items[start:start + size] for start in range(0, len(items), size)]
+        with ctx.span('render'):
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                futures = []
+                for chunk in chunks:
+                    futures.append(pool.submit(renderChunk, ctx.templateDir, ctx.cacheDir, ctx.orgId, ctx.region, chunk))
+                for future in futures:
+                    for key, doc in future.result():
+                        storeRender(ctx, 'policy', cacheKeys[key], doc)
+                        self.byInputs[key] = self.intern(doc)
+        for policyName in self.index:
+            self[policyName]
+
+    def __contains__(self, policyName):
+        return policyName in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
 
+@spanned('templates')
 def loadPolicyTemplates(ctx):
     if ctx.templateDir == None:
         print('loadPolicyTemplates: No templateDir')
@@ -148,6 +458,106 @@ class Reorder(object):
             lnew.append(OrderedDict((k, obj[k]) for k in self.model))
         return lnew
 
+'''
+Canonical form of a policy document, used to decide whether two documents
+are equivalent.  AWS is free to hand a document back in a different shape
+than it was given, so single strings and lists are treated alike, action
+and resource lists are sorted, and the order of the statements is ignored.
+'''
+canonicalListKeys = ['Action', 'NotAction', 'Resource', 'NotResource']
+
+def canonicalValues(value):
+    '''
+    A single string is a list of one, and lists are sorted without
+    duplicates.  Other values, such as the booleans and numbers of some
+    conditions, are kept as they are.  Lists are sorted by their JSON, which
+    orders values of mixed types and keeps true apart from 1.
+    '''
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, (list, tuple)):
+        return value
+    unique = dict((json.dumps(item, sort_keys=True), item) for item in value)
+    return [unique[key] for key in sorted(unique)]
+
+def canonicalStatement(stmt):
+    canon = {}
+    for key in stmt:
+        value = stmt[key]
+        if key in canonicalListKeys:
+            value = canonicalValues(value)
+        elif key == 'Condition':
+            value = dict((op, dict((k, canonicalValues(v)) for k, v in value[op].items()))
+                for op in value)
+        canon[key] = value
+    return canon
+
+def canonicalPolicy(policyDoc):
+    statements = policyDoc.get('Statement', [])
+    if isinstance(statements, dict):
+        statements = [statements]
+    canon = dict(policyDoc)
+    canon['Statement'] = sorted((canonicalStatement(stmt) for stmt in statements),
+        key=lambda stmt: json.dumps(stmt, sort_keys=True))
+    return canon
+
+def policyHash(policyDoc):
+    if isinstance(policyDoc, FrozenDocument):
+        return policyDoc.policyHash()
+    canon = json.dumps(canonicalPolicy(policyDoc), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canon.encode('utf-8')).hexdigest()
+
+def documentHash(doc):
+    ''' Hash of the document exactly as it is serialized, key order included '''
+    content = json.dumps(doc, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+'''
+A rendered model document that can be shared by every policy that renders
+the same, so it must not change.  Its lists are tuples, which serialize the
+same, and it keeps its content hash and, once asked for, its policyHash.
+'''
+class FrozenDocument(OrderedDict):
+    def __init__(self, pairs):
+        OrderedDict.__init__(self, pairs)
+        self.contentHash = documentHash(self)
+        self.canonicalHash = None
+        self.frozen = True
+
+    def policyHash(self):
+        if self.canonicalHash == None:
+            canon = json.dumps(canonicalPolicy(self), sort_keys=True, separators=(',', ':'))
+            self.canonicalHash = hashlib.sha256(canon.encode('utf-8')).hexdigest()
+        return self.canonicalHash
+
+    def refuse(self, *args, **kwargs):
+        raise TypeError('model documents are shared and cannot be changed')
+
+    def __setitem__(self, key, value):
+        if getattr(self, 'frozen', False):
+            self.refuse()
+        OrderedDict.__setitem__(self, key, value)
+
+    __delitem__ = refuse
+    clear = refuse
+    pop = refuse
+    popitem = refuse
+    setdefault = refuse
+    update = refuse
+    move_to_end = refuse
+
+    def __reduce__(self):
+        return (FrozenDocument, (list(self.items()),))
+
+def freezeDocument(value):
+    if isinstance(value, FrozenDocument):
+        return value
+    if isinstance(value, dict):
+        return FrozenDocument((key, freezeDocument(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(freezeDocument(item) for item in value)
+    return value
+
 def showPolicyJson(ctx, policyDoc, offset, width):
     lineLen = width - offset
 